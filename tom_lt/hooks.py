@@ -0,0 +1,11 @@
+from tom_common.hooks import target_post_save as tom_target_post_save
+
+
+def target_post_save(target, created):
+    """
+    Drop the target's cached LT coordinates, then run the default TOM hook.
+    """
+    from tom_lt.lt import coordinate_cache
+
+    coordinate_cache.invalidate(target)
+    tom_target_post_save(target, created)
@@ -1,15 +1,22 @@
+import copy
+import functools
+import hashlib
+import importlib
+import json
+import logging
+import os
+import re
+import threading
 import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
-from lxml import etree
-from suds import Client
-from dateutil.parser import parse
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from django import forms
 from django.conf import settings
-
-from astropy.coordinates import SkyCoord
-from astropy import units as u
+from django.core.cache import caches
+from django.forms.forms import DeclarativeFieldsMetaclass
 
 from crispy_forms.layout import Layout, Div, HTML
 from crispy_forms.bootstrap import PrependedAppendedText, PrependedText, InlineRadios
@@ -17,6 +24,34 @@ from crispy_forms.bootstrap import PrependedAppendedText, PrependedText, InlineR
 from tom_observations.facility import GenericObservationForm, GenericObservationFacility
 from tom_targets.models import Target
 
+from tom_lt import lt_download, lt_queue
+from tom_lt.lt_archive import RTMLArchive
+from tom_lt.lt_metrics import metrics
+from tom_lt.lt_resilience import CircuitBreaker, CircuitOpenError, retry
+
+logger = logging.getLogger(__name__)
+
+
+class _LazyModule:
+    """
+    Stand-in for a module that is only imported when one of its attributes is first used.
+
+    Looked-up attributes are copied onto the stand-in, so later uses cost a plain attribute lookup.
+    """
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attribute):
+        value = getattr(importlib.import_module(self._name), attribute)
+        setattr(self, attribute, value)
+        return value
+
+
+# lxml is needed by every RTML payload but not by manage.py commands or worker boot, which import
+# this module through the facility registry, so defer it (and suds, astropy and dateutil, which
+# are imported where they are used) until an LT form or node agent call needs it
+etree = _LazyModule('lxml.etree')
+
 
 try:
     LT_SETTINGS = settings.FACILITIES['LT']
@@ -30,11 +65,951 @@ except (AttributeError, KeyError):
         'DEBUG': False,
     }
 
+# How long (in seconds) a pooled node agent client is reused before the WSDL is fetched again
+LT_CLIENT_MAX_AGE = LT_SETTINGS.get('CLIENT_MAX_AGE', 3600)
+# Directory for suds' on-disk cache of the parsed WSDL; None keeps suds' default location
+LT_WSDL_CACHE_DIR = LT_SETTINGS.get('WSDL_CACHE_DIR')
+# Local copy of the RTML 3.1a schema named in LT_SCHEMA_LOCATION, used to validate payloads offline
+LT_SCHEMA_FILE = LT_SETTINGS.get('SCHEMA_FILE')
+# How long (in seconds) an offer from the node agent is trusted before validation asks it again
+LT_INQUIRY_FRESHNESS = LT_SETTINGS.get('INQUIRY_FRESHNESS', 300)
+# Django cache used to memoize node agent verdicts; its MAX_ENTRIES option bounds the number kept
+LT_VALIDATION_CACHE = LT_SETTINGS.get('VALIDATION_CACHE', 'default')
+LT_VALIDATION_CACHE_TTL = LT_SETTINGS.get('VALIDATION_CACHE_TTL', 600)
+# Upper bound on node agent requests in flight at once for batched submissions
+LT_MAX_CONCURRENT_SUBMISSIONS = LT_SETTINGS.get('MAX_CONCURRENT_SUBMISSIONS', 4)
+# Most windows a cadence request may generate, and the most Schedules sent in one RTML document
+# (larger cadence requests are split into several documents; None sends them as one group)
+LT_CADENCE_MAX_WINDOWS = LT_SETTINGS.get('CADENCE_MAX_WINDOWS', 1000)
+LT_CADENCE_BATCH_SIZE = LT_SETTINGS.get('CADENCE_BATCH_SIZE')
+# How long (in seconds) an observation status fetched from the node agent is reused
+LT_STATUS_CACHE_TTL = LT_SETTINGS.get('STATUS_CACHE_TTL', 120)
+# Socket timeouts (in seconds) for submissions and for inquiries to the node agent
+LT_TIMEOUT = LT_SETTINGS.get('TIMEOUT', 60)
+LT_INQUIRY_TIMEOUT = LT_SETTINGS.get('INQUIRY_TIMEOUT', 15)
+# How node agent calls are made: 'suds' runs suds clients on a thread pool, 'async' sends SOAP
+# envelopes from an asyncio event loop over keep-alive connections. Either runs at most
+# TRANSPORT_CONCURRENCY calls at once
+LT_TRANSPORT = LT_SETTINGS.get('TRANSPORT', 'suds')
+LT_TRANSPORT_CONCURRENCY = LT_SETTINGS.get('TRANSPORT_CONCURRENCY', LT_MAX_CONCURRENT_SUBMISSIONS)
+# Namespace of the handle_rtml operation used by the async transport. By default it is read from
+# the targetNamespace of the node agent WSDL when the transport is built
+LT_TRANSPORT_NAMESPACE = LT_SETTINGS.get('TRANSPORT_NAMESPACE')
+# Extra attempts for idempotent inquiries, with jittered exponential backoff between them
+LT_INQUIRY_RETRIES = LT_SETTINGS.get('INQUIRY_RETRIES', 2)
+LT_RETRY_BASE_DELAY = LT_SETTINGS.get('RETRY_BASE_DELAY', 0.5)
+LT_RETRY_MAX_DELAY = LT_SETTINGS.get('RETRY_MAX_DELAY', 5)
+# Consecutive failures that open the circuit breaker, and how long it then fails fast for
+LT_BREAKER_THRESHOLD = LT_SETTINGS.get('BREAKER_THRESHOLD', 5)
+LT_BREAKER_COOLDOWN = LT_SETTINGS.get('BREAKER_COOLDOWN', 60)
+# Optional StatsD daemon that timings and counters are also sent to
+LT_STATSD_HOST = LT_SETTINGS.get('STATSD_HOST')
+LT_STATSD_PORT = LT_SETTINGS.get('STATSD_PORT', 8125)
+# Identifies this host (0-999) in generated uids, alongside the pid. Every host that builds RTML
+# documents needs its own WORKER_ID; a single-host deployment can leave it at 0
+LT_WORKER_ID = LT_SETTINGS.get('WORKER_ID', 0)
+# Number of targets whose sexagesimal coordinates are kept in process, in front of the Django
+# cache (VALIDATION_CACHE), where they are kept for COORDINATE_CACHE_TTL seconds
+LT_COORDINATE_LRU_SIZE = LT_SETTINGS.get('COORDINATE_LRU_SIZE', 1024)
+LT_COORDINATE_CACHE_TTL = LT_SETTINGS.get('COORDINATE_CACHE_TTL', 30 * 24 * 3600)
+# Number of recent uids remembered for mapping node agent responses back to their requests
+LT_UID_INDEX_SIZE = LT_SETTINGS.get('UID_INDEX_SIZE', 10000)
+# Data product downloads: transfers in flight at once, bytes per chunk and socket timeout
+LT_MAX_CONCURRENT_DOWNLOADS = LT_SETTINGS.get('MAX_CONCURRENT_DOWNLOADS', 4)
+LT_DOWNLOAD_CHUNK_SIZE = LT_SETTINGS.get('DOWNLOAD_CHUNK_SIZE', lt_download.DEFAULT_CHUNK_SIZE)
+LT_DOWNLOAD_TIMEOUT = LT_SETTINGS.get('DOWNLOAD_TIMEOUT', 60)
+
+# Whether to 'warn' about, 'confirm' or 'block' requests whose target never gets below the maximum
+# airmass at night during the observing window (None to skip the check), the sun altitude (degrees)
+# that counts as night, and the spacing (minutes) of the time grid the check is made on. 'confirm'
+# holds an interactive request back once, until the user ticks a box to submit it anyway
+LT_VISIBILITY_CHECK = LT_SETTINGS.get('VISIBILITY_CHECK', 'warn')
+LT_NIGHT_SUN_ALTITUDE = LT_SETTINGS.get('NIGHT_SUN_ALTITUDE', -12)
+LT_VISIBILITY_STEP = LT_SETTINGS.get('VISIBILITY_STEP', 10)
+
+# Non-sidereal targets are requested in sub-windows over which they move at most this many
+# arcseconds, with their ephemeris computed every EPHEMERIS_STEP minutes
+LT_EPHEMERIS_MAX_MOTION = LT_SETTINGS.get('EPHEMERIS_MAX_MOTION', 60)
+LT_EPHEMERIS_STEP = LT_SETTINGS.get('EPHEMERIS_STEP', 10)
+
+# Every RTML exchange is appended to a compressed archive here, rotated daily or at ARCHIVE_MAX_BYTES;
+# at most ARCHIVE_MAX_BACKLOG exchanges wait in memory to be written
+LT_ARCHIVE_DIR = LT_SETTINGS.get('ARCHIVE_DIR', 'rtml_archive')
+LT_ARCHIVE_MAX_BYTES = LT_SETTINGS.get('ARCHIVE_MAX_BYTES', 10 * 1024 * 1024)
+LT_ARCHIVE_MAX_BACKLOG = LT_SETTINGS.get('ARCHIVE_MAX_BACKLOG', 10000)
+
 
 LT_XML_NS = 'http://www.rtml.org/v3.1a'
 LT_XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
 LT_SCHEMA_LOCATION = 'http://www.rtml.org/v3.1a http://telescope.livjm.ac.uk/rtml/RTML-nightly.xsd'
 
+# TOM observation states for the modes of RTML documents returned by the node agent
+LT_RTML_MODE_STATES = {
+    'request': 'PENDING',
+    'offer': 'PENDING',
+    'confirmation': 'PENDING',
+    'update': 'IN_PROGRESS',
+    'complete': 'COMPLETED',
+    'incomplete': 'FAILED',
+    'fail': 'FAILED',
+    'reject': 'FAILED',
+    'abort': 'CANCELED',
+}
+# TOM observation states for submissions still in the tom_lt.lt_queue submission queue
+LT_QUEUE_STATES = {
+    lt_queue.QUEUED: 'PENDING',
+    lt_queue.SENDING: 'PENDING',
+    lt_queue.FAILED: 'FAILED',
+    lt_queue.CANCELED: 'CANCELED',
+}
+
+
+class LTClientPool:
+    """
+    Process-wide pool of suds clients for the LT node agent, keyed by host, port and credentials.
+
+    Each checkout hands out a client that no other thread is using, so threaded workers never share
+    one concurrently. Returned clients are reused until they are older than ``max_age`` seconds.
+    The parsed WSDL is kept in suds' on-disk object cache, so only the first client built for a
+    key (or the first after the cache expires) fetches and parses it from the node agent.
+    """
+    def __init__(self, max_age=LT_CLIENT_MAX_AGE):
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._cache = None
+
+    def _wsdl_cache(self):
+        if self._cache is None:
+            from suds.cache import ObjectCache
+
+            with self._lock:
+                if self._cache is None:
+                    self._cache = ObjectCache(location=LT_WSDL_CACHE_DIR, seconds=self.max_age)
+        return self._cache
+
+    @staticmethod
+    def _key(lt_settings):
+        return (lt_settings['LT_HOST'], str(lt_settings['LT_PORT']),
+                lt_settings['username'], lt_settings['password'])
+
+    def _build_client(self, lt_settings):
+        from suds import Client
+
+        headers = {
+            'Username': lt_settings['username'],
+            'Password': lt_settings['password']
+        }
+        url = '{0}://{1}:{2}/node_agent2/node_agent?wsdl'.format('http', lt_settings['LT_HOST'],
+                                                                 lt_settings['LT_PORT'])
+        with metrics.timed('client_build'):
+            return Client(url=url, headers=headers, cache=self._wsdl_cache())
+
+    def _acquire(self, key, lt_settings):
+        now = time.monotonic()
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            while idle:
+                client, created = idle.pop()
+                if now - created < self.max_age:
+                    self.hits += 1
+                    return client, created
+            self.misses += 1
+        # Build outside the lock so that a slow WSDL fetch does not hold up other checkouts
+        return self._build_client(lt_settings), now
+
+    def _release(self, key, client, created):
+        if time.monotonic() - created < self.max_age:
+            with self._lock:
+                self._idle.setdefault(key, []).append((client, created))
+
+    @contextmanager
+    def checkout(self, lt_settings=None):
+        """
+        Check out a client for the node agent described by ``lt_settings``, returning it to the
+        pool afterwards.
+        """
+        lt_settings = lt_settings or LT_SETTINGS
+        key = self._key(lt_settings)
+        with metrics.timed('client_acquire'):
+            client, created = self._acquire(key, lt_settings)
+        try:
+            yield client
+        finally:
+            self._release(key, client, created)
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+        if self._cache is not None:
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(clients) for clients in self._idle.values())
+        return {'hits': self.hits, 'misses': self.misses, 'idle': idle}
+
+
+client_pool = LTClientPool()
+metrics.register_gauge('client_pool_hits', lambda: client_pool.hits)
+metrics.register_gauge('client_pool_misses', lambda: client_pool.misses)
+metrics.configure_statsd(LT_STATSD_HOST, LT_STATSD_PORT)
+
+
+class UIDGenerator:
+    """
+    Generates RTML uids that are unique across threads and processes and increase monotonically
+    within a process. A uid is the time in milliseconds, the three digit WORKER_ID of the host, the
+    seven digit pid (Linux pids never exceed 4194304) and a four digit sequence number, which
+    allows ten thousand uids per millisecond per process.
+    """
+    def __init__(self, worker_id=LT_WORKER_ID):
+        self._configured_worker_id = worker_id
+        self._lock = threading.Lock()
+        self._pid = None
+        self._last_ms = 0
+        self._sequence = 0
+
+    def _reset(self):
+        # Called on first use and again in a forked child, which must not reuse its parent's id
+        self._pid = os.getpid()
+        host_id = int(self._configured_worker_id or 0)
+        if not 0 <= host_id <= 999:
+            raise ValueError('LT WORKER_ID must be between 0 and 999, not {0}'.format(host_id))
+        self.worker_id = '{0:03d}{1:07d}'.format(host_id, self._pid)
+        self._last_ms = 0
+        self._sequence = 0
+
+    def next(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            # Never go backwards, even if the system clock does
+            now_ms = max(int(time.time() * 1000), self._last_ms)
+            if now_ms == self._last_ms:
+                self._sequence += 1
+                if self._sequence > 9999:
+                    now_ms += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            return '{0}{1}{2:04d}'.format(now_ms, self.worker_id, self._sequence)
+
+
+class UIDIndex:
+    """
+    Bounded map from the uids of recently built payloads to details of the request, so that the
+    uid echoed back by the node agent can be traced to the request it answers.
+    """
+    def __init__(self, maxsize=LT_UID_INDEX_SIZE):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def add(self, uid, **details):
+        with self._lock:
+            self._entries[uid] = details
+            self._entries.move_to_end(uid)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get(self, uid, default=None):
+        with self._lock:
+            return self._entries.get(str(uid), default)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+uid_generator = UIDGenerator()
+uid_index = UIDIndex()
+
+
+class CoordinateCache:
+    """
+    Cache of the sexagesimal RA and Dec strings of targets, keyed by target pk.
+
+    Lookups try a bounded in-process LRU first, then the VALIDATION_CACHE Django cache, and only
+    convert the coordinates with astropy when both miss. Each entry stores the ra, dec and epoch it
+    was converted from and is ignored once they no longer match, so an edited target is never served
+    stale strings; tom_lt.hooks.target_post_save still drops its entries so they do not linger.
+    """
+    def __init__(self, maxsize=LT_COORDINATE_LRU_SIZE, ttl=LT_COORDINATE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def _key(target):
+        return 'tom_lt.coordinates.{0}'.format(target.pk)
+
+    @staticmethod
+    def _coordinates(target):
+        return (target.ra, target.dec, target.epoch)
+
+    @staticmethod
+    def _convert(target):
+        from astropy.coordinates import SkyCoord
+        from astropy import units as u
+
+        c = SkyCoord(ra=target.ra*u.degree, dec=target.dec*u.degree)
+        ra_hms = c.ra.hms
+        dec_dms = c.dec.signed_dms
+        sign = '+' if dec_dms.sign > 0 else '-'
+        return (str(int(ra_hms.h)), str(int(ra_hms.m)), str(ra_hms.s),
+                sign + str(int(dec_dms.d)), str(int(dec_dms.m)), str(dec_dms.s))
+
+    def get(self, target):
+        """
+        Return (hours, minutes, seconds, degrees, arcminutes, arcseconds) strings for ``target``.
+        """
+        key = self._key(target)
+        coordinates = self._coordinates(target)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == coordinates:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        cache = caches[LT_VALIDATION_CACHE]
+        entry = cache.get(key)
+        if entry is None or tuple(entry[0]) != coordinates:
+            self.misses += 1
+            entry = (coordinates, self._convert(target))
+            cache.set(key, entry, self.ttl)
+        else:
+            entry = (coordinates, tuple(entry[1]))
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return entry[1]
+
+    def invalidate(self, target):
+        key = self._key(target)
+        with self._lock:
+            self._entries.pop(key, None)
+        caches[LT_VALIDATION_CACHE].delete(key)
+
+
+coordinate_cache = CoordinateCache()
+metrics.register_gauge('coordinate_cache_hits', lambda: coordinate_cache.hits)
+
+
+_rtml_schema = None
+# When the node agent last made an offer, keyed by node agent, credentials and proposal
+_last_offers = {}
+
+
+def get_rtml_schema():
+    """
+    Return the compiled RTML schema from LT_SCHEMA_FILE, compiling it on first use.
+    Returns None when no local schema is configured.
+    """
+    global _rtml_schema
+    if _rtml_schema is None and LT_SCHEMA_FILE:
+        _rtml_schema = etree.XMLSchema(etree.parse(LT_SCHEMA_FILE))
+    return _rtml_schema
+
+
+class RTMLDocument:
+    """
+    An RTML payload built by the LT forms, kept as an lxml tree.
+
+    The tree is serialized lazily, the first time the document is used as a string, and the result
+    is reused from then on. ``inquiry()`` gives the inquiry-mode variant of the same tree without
+    copying or reparsing it.
+    """
+    def __init__(self, element, mode=None):
+        self.element = element
+        self.mode = mode
+        self._text = None
+
+    def __str__(self):
+        if self._text is None:
+            self._text = self._serialize()
+        return self._text
+
+    def _serialize(self, **kwargs):
+        if self.mode is None:
+            return etree.tostring(self.element, encoding='unicode', **kwargs)
+        original = self.element.get('mode')
+        self.element.set('mode', self.mode)
+        try:
+            return etree.tostring(self.element, encoding='unicode', **kwargs)
+        finally:
+            self.element.set('mode', original)
+
+    def pretty(self):
+        return self._serialize(pretty_print=True)
+
+    def inquiry(self):
+        return RTMLDocument(self.element, mode='inquiry')
+
+    def batches(self, size):
+        """
+        Split the document into documents of at most ``size`` Schedules each, sharing its Project
+        and each with a uid of its own. The Schedules of one observing window are never split, so a
+        window with more than ``size`` of them is sent whole in a document of its own. Returns
+        ``[self]`` if it is small enough, or ``size`` is None.
+        """
+        if not size:
+            return [self]
+        schedules = self.element.findall('{*}Schedule')
+        if len(schedules) <= size:
+            return [self]
+        root = self.element
+        shared = [child for child in root
+                  if not (isinstance(child.tag, str) and etree.QName(child).localname == 'Schedule')]
+        # Consecutive Schedules with the same DateTimeConstraint belong to one window
+        groups = []
+        last_window = None
+        for schedule in schedules:
+            window = (schedule.find('{*}DateTimeConstraint/{*}DateTimeStart'),
+                      schedule.find('{*}DateTimeConstraint/{*}DateTimeEnd'))
+            window = tuple(None if bound is None else bound.get('value') for bound in window)
+            if groups and window == last_window:
+                groups[-1].append(schedule)
+            else:
+                groups.append([schedule])
+                last_window = window
+        batches = [[]]
+        for group in groups:
+            if batches[-1] and len(batches[-1]) + len(group) > size:
+                batches.append([])
+            batches[-1].extend(group)
+        if len(batches) == 1:
+            return [self]
+        details = uid_index.get(root.get('uid'), {})
+        documents = []
+        for batch in batches:
+            element = etree.Element(root.tag, root.attrib, nsmap=root.nsmap)
+            element.set('uid', uid_generator.next())
+            uid_index.add(element.get('uid'), **details)
+            element.extend(copy.deepcopy(child) for child in shared)
+            element.extend(copy.deepcopy(schedule) for schedule in batch)
+            documents.append(RTMLDocument(element, mode=self.mode))
+        return documents
+
+    @classmethod
+    def parse(cls, observation_payload):
+        """
+        Wrap a payload that may already be an RTMLDocument or may be serialized RTML.
+        """
+        if isinstance(observation_payload, cls):
+            return observation_payload
+        document = cls(etree.fromstring(observation_payload))
+        document._text = observation_payload
+        return document
+
+
+_XML_DECLARATION_ENCODING = re.compile(r'^\s*<\?xml[^>]*?encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+RESPONSE_CHUNK_SIZE = 64 * 1024
+
+
+def _response_chunks(response, chunk_size=RESPONSE_CHUNK_SIZE):
+    """
+    Yield a node agent response as byte chunks in the encoding it declares, whether it is given
+    as a string, as bytes, as a file-like object or as an iterable of byte chunks.
+    """
+    if isinstance(response, str):
+        # suds has already decoded the response, so re-encode it to match its XML declaration
+        match = _XML_DECLARATION_ENCODING.match(response)
+        encoding = match.group(1) if match else 'utf-8'
+        for start in range(0, len(response), chunk_size):
+            yield response[start:start + chunk_size].encode(encoding, 'xmlcharrefreplace')
+    elif isinstance(response, bytes):
+        view = memoryview(response)
+        for start in range(0, len(response), chunk_size):
+            yield bytes(view[start:start + chunk_size])
+    elif hasattr(response, 'read'):
+        for chunk in iter(lambda: response.read(chunk_size), b''):
+            yield chunk
+    else:
+        yield from response
+
+
+def iter_rtml_elements(response, tag):
+    """
+    Incrementally parse a node agent response, yielding each element with the local name ``tag``
+    once it is complete. Elements are discarded after they have been yielded, so arbitrarily long
+    listings (e.g. many Schedules or ImageData entries) never need the whole tree in memory.
+    """
+    parser = etree.XMLPullParser(events=('end',))
+    for chunk in _response_chunks(response):
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            if etree.QName(element).localname == tag:
+                yield element
+                element.clear()
+                # Drop the siblings already processed as well as the element itself
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+    parser.close()
+
+
+def read_rtml_header(response):
+    """
+    Return the attributes (mode, type, uid, ...) of the root RTML element of a node agent
+    response, parsing no further than the root's start tag.
+    """
+    parser = etree.XMLPullParser(events=('start',))
+    for chunk in _response_chunks(response):
+        parser.feed(chunk)
+        for _, element in parser.read_events():
+            return dict(element.attrib)
+    raise etree.XMLSyntaxError('Empty response from the node agent', None, 0, 0)
+
+
+class RTMLResponse:
+    """
+    A response from the node agent. The root attributes are read as soon as the root start tag
+    has been parsed, and the full tree is only built if ``element`` is asked for.
+    """
+    def __init__(self, response):
+        self.response = response
+        with metrics.timed('response_parse'):
+            self.attrib = read_rtml_header(response)
+        self._element = None
+
+    def get(self, name, default=None):
+        return self.attrib.get(name, default)
+
+    @property
+    def rejected(self):
+        """
+        Whether the node agent rejected the document, which it signals in either its mode or type.
+        """
+        return self.get('mode') == 'reject' or self.get('type') == 'reject'
+
+    @property
+    def element(self):
+        if self._element is None:
+            parser = etree.XMLParser()
+            for chunk in _response_chunks(self.response):
+                parser.feed(chunk)
+            self._element = parser.close()
+        return self._element
+
+    def iter(self, tag):
+        return iter_rtml_elements(self.response, tag)
+
+
+class RTMLRejectError(Exception):
+    """
+    Raised when the node agent rejects a submitted observation request.
+    """
+
+
+rtml_archive = RTMLArchive(LT_ARCHIVE_DIR, max_bytes=LT_ARCHIVE_MAX_BYTES, max_backlog=LT_ARCHIVE_MAX_BACKLOG)
+metrics.register_gauge('archive_backlog', lambda: rtml_archive.backlog)
+
+node_agent_breaker = CircuitBreaker(failure_threshold=LT_BREAKER_THRESHOLD, cooldown=LT_BREAKER_COOLDOWN)
+metrics.register_gauge('node_agent_breaker_open', lambda: int(node_agent_breaker.state != CircuitBreaker.CLOSED))
+
+
+_transport_state = {'transport': None}
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    """
+    Return the process-wide node agent transport selected by TRANSPORT, building it on first use.
+    """
+    if _transport_state['transport'] is None:
+        from tom_lt.lt_transport import AsyncSOAPTransport, SudsThreadTransport
+
+        with _transport_lock:
+            if _transport_state['transport'] is None:
+                if LT_TRANSPORT == 'async':
+                    namespace = LT_TRANSPORT_NAMESPACE
+                    if namespace is None:
+                        with client_pool.checkout() as client:
+                            namespace = client.wsdl.tns[1]
+                    transport = AsyncSOAPTransport(LT_SETTINGS, max_concurrency=LT_TRANSPORT_CONCURRENCY,
+                                                   timeout=LT_TIMEOUT, namespace=namespace)
+                elif LT_TRANSPORT == 'suds':
+                    transport = SudsThreadTransport(client_pool, max_concurrency=LT_TRANSPORT_CONCURRENCY,
+                                                    timeout=LT_TIMEOUT)
+                else:
+                    raise ValueError('Unknown LT TRANSPORT {0!r}, expected suds or async'.format(LT_TRANSPORT))
+                _transport_state['transport'] = transport
+    return _transport_state['transport']
+
+
+def call_node_agent(document, idempotent=False):
+    """
+    Send an RTML document to the node agent and return its RTMLResponse.
+
+    Every call goes through the circuit breaker, so calls fail immediately with CircuitOpenError
+    while the node agent is known to be down. Idempotent calls (inquiries) use the shorter
+    INQUIRY_TIMEOUT and are retried with backoff; submissions are sent exactly once. Each exchange
+    is recorded in the RTML archive.
+    """
+    document = RTMLDocument.parse(document)
+    timeout = LT_INQUIRY_TIMEOUT if idempotent else LT_TIMEOUT
+
+    def attempt():
+        with metrics.timed('handle_rtml', mode=document.mode or document.element.get('mode')):
+            response = get_transport().handle_rtml(str(document), timeout)
+        rtml_archive.record(document.element.get('uid'), str(document), str(response))
+        return RTMLResponse(response)
+
+    return retry(lambda: node_agent_breaker.call(attempt),
+                 attempts=LT_INQUIRY_RETRIES + 1 if idempotent else 1,
+                 base_delay=LT_RETRY_BASE_DELAY, max_delay=LT_RETRY_MAX_DELAY)
+
+
+def call_node_agent_many(documents, idempotent=False):
+    """
+    Send many RTML documents to the node agent at once, returning one RTMLResponse per document,
+    in order, or the exception its call failed with.
+
+    All the calls are handed to the transport together, which runs TRANSPORT_CONCURRENCY of them
+    at a time. Each call goes through the circuit breaker and is archived as in call_node_agent,
+    and failed idempotent calls are then retried one by one through call_node_agent.
+    """
+    documents = [RTMLDocument.parse(document) for document in documents]
+    if not documents:
+        return []
+    timeout = LT_INQUIRY_TIMEOUT if idempotent else LT_TIMEOUT
+    transport = get_transport()
+
+    def timed(future, mode, start):
+        if future.cancelled() or future.exception() is not None:
+            metrics.increment('handle_rtml_errors', mode=mode)
+        metrics.observe('handle_rtml', time.perf_counter() - start, mode=mode)
+
+    calls = []
+    for document in documents:
+        try:
+            node_agent_breaker.before_call()
+        except CircuitOpenError as e:
+            calls.append(e)
+            continue
+        future = transport.submit(str(document), timeout)
+        future.add_done_callback(functools.partial(timed, mode=document.mode or document.element.get('mode'),
+                                                   start=time.perf_counter()))
+        calls.append(future)
+
+    results = []
+    for document, call in zip(documents, calls):
+        if isinstance(call, Exception):
+            results.append(call)
+            continue
+        try:
+            response = call.result()
+        except Exception as e:
+            node_agent_breaker.record_failure()
+            results.append(e)
+            continue
+        node_agent_breaker.record_success()
+        rtml_archive.record(document.element.get('uid'), str(document), str(response))
+        results.append(RTMLResponse(response))
+
+    if idempotent:
+        for i, result in enumerate(results):
+            if isinstance(result, Exception) and not isinstance(result, CircuitOpenError):
+                try:
+                    results[i] = call_node_agent(documents[i], idempotent=True)
+                except Exception as e:
+                    results[i] = e
+    return results
+
+
+def build_rtml_document(mode, uid):
+    """
+    Build an empty RTML document with the given mode and uid.
+    """
+    namespaces = {
+        'xsi': LT_XSI_NS,
+    }
+    schemaLocation = etree.QName(LT_XSI_NS, 'schemaLocation')
+    return etree.Element('RTML', {schemaLocation: LT_SCHEMA_LOCATION}, xmlns=LT_XML_NS,
+                         mode=mode, uid=str(uid), version='3.1a', nsmap=namespaces)
+
+
+def build_status_inquiry(observation_id):
+    """
+    Build the inquiry document asking the node agent for the state of a submitted observation.
+    """
+    payload = build_rtml_document('inquiry', observation_id)
+    project = etree.SubElement(payload, 'Project')
+    contact = etree.SubElement(project, 'Contact')
+    etree.SubElement(contact, 'Username').text = LT_SETTINGS['username']
+    return RTMLDocument(payload)
+
+
+def project_ids(observation_ids):
+    """
+    Map observation ids to the proposal they were submitted under: from the uid index for uids
+    built by this process, otherwise, with a single query, from the parameters of their
+    ObservationRecords (for uids built by another worker or before a restart).
+    """
+    from tom_observations.models import ObservationRecord
+
+    projects = {}
+    missing = []
+    for observation_id in observation_ids:
+        details = uid_index.get(observation_id)
+        if details and details.get('project'):
+            projects[observation_id] = details['project']
+        else:
+            missing.append(observation_id)
+    if missing:
+        records = ObservationRecord.objects.filter(facility='LT', observation_id__in=missing)
+        for observation_id, parameters in records.values_list('observation_id', 'parameters'):
+            # Older TOM Toolkit versions store the parameters as a JSON string
+            if isinstance(parameters, str):
+                parameters = json.loads(parameters)
+            if parameters and parameters.get('project'):
+                projects.setdefault(observation_id, parameters['project'])
+    return projects
+
+
+def build_cancel_document(observation_id, project_id=None):
+    """
+    Build the abort document withdrawing a submitted observation. ``project_id`` is looked up with
+    project_ids() when not given. An observation that cannot be traced to a proposal (one never
+    recorded in this TOM) is aborted without a ProjectID, by uid and username alone.
+    """
+    if project_id is None:
+        project_id = project_ids([observation_id]).get(observation_id)
+    payload = build_rtml_document('abort', observation_id)
+    project = etree.SubElement(payload, 'Project')
+    if project_id:
+        project.set('ProjectID', project_id)
+    contact = etree.SubElement(project, 'Contact')
+    etree.SubElement(contact, 'Username').text = LT_SETTINGS['username']
+    return RTMLDocument(payload)
+
+
+def build_target_elements(name, ra, dec, equinox):
+    """
+    Build a <Target> element for each of the positions in the ``ra`` and ``dec`` arrays (degrees),
+    converting them all to sexagesimal at once.
+    """
+    from tom_lt.lt_ephemeris import sexagesimal
+
+    (hours, minutes, seconds), (signs, degrees, arcminutes, arcseconds) = sexagesimal(ra, dec)
+    targets = []
+    for i in range(len(hours)):
+        target = etree.Element('Target', name=name)
+        coordinates = etree.SubElement(target, 'Coordinates')
+        ra_element = etree.SubElement(coordinates, 'RightAscension')
+        etree.SubElement(ra_element, 'Hours').text = str(int(hours[i]))
+        etree.SubElement(ra_element, 'Minutes').text = str(int(minutes[i]))
+        etree.SubElement(ra_element, 'Seconds').text = '{0:.3f}'.format(seconds[i])
+        dec_element = etree.SubElement(coordinates, 'Declination')
+        etree.SubElement(dec_element, 'Degrees').text = signs[i] + str(int(degrees[i]))
+        etree.SubElement(dec_element, 'Arcminutes').text = str(int(arcminutes[i]))
+        etree.SubElement(dec_element, 'Arcseconds').text = '{0:.2f}'.format(arcseconds[i])
+        etree.SubElement(coordinates, 'Equinox').text = str(equinox)
+        targets.append(target)
+    return targets
+
+
+def rtml_digest(payload):
+    """
+    Hash an RTML document in canonical (C14N) form, ignoring its uid, so that payloads which differ
+    only by the uid from _build_prolog share a digest.
+    """
+    uid = payload.attrib.pop('uid', None)
+    try:
+        canonical = etree.tostring(payload, method='c14n')
+    finally:
+        if uid is not None:
+            payload.set('uid', uid)
+    return hashlib.sha256(canonical).hexdigest()
+
+
+def check_rtml(payload):
+    """
+    Validate an RTML request document offline, against the local schema (if configured) and
+    the rules the LT node agent applies to incoming requests. Returns a list of errors.
+    """
+    errors = []
+    schema = get_rtml_schema()
+    if schema is not None and not schema.validate(payload):
+        errors.extend(str(error) for error in schema.error_log)
+
+    # Payloads may or may not carry the RTML namespace depending on whether they have been parsed
+    if not payload.findtext('{*}Project/{*}Contact/{*}Username'):
+        errors.append('No Liverpool Telescope username is configured')
+    project = payload.find('{*}Project')
+    if project is None or not project.get('ProjectID'):
+        errors.append('A proposal must be selected')
+
+    schedules = payload.findall('{*}Schedule')
+    if not schedules:
+        errors.append('At least one exposure must be requested')
+    total_count = 0
+    for schedule in schedules:
+        exposure = schedule.find('{*}Exposure')
+        try:
+            count = int(exposure.get('count'))
+            exp_time = float(exposure.findtext('{*}Value'))
+        except (AttributeError, TypeError, ValueError):
+            errors.append('Malformed exposure in schedule')
+            continue
+        if count < 0 or exp_time < 0:
+            errors.append('Exposure times and counts must not be negative')
+        total_count += count
+        if schedule.find('{*}Target/{*}Coordinates') is None:
+            errors.append('Schedule has no target coordinates')
+
+        airmass = schedule.find('{*}AirmassConstraint')
+        if airmass is not None and not 1 <= float(airmass.get('maximum')) <= 3:
+            errors.append('Maximum airmass must be between 1 and 3')
+        start = schedule.find('{*}DateTimeConstraint/{*}DateTimeStart')
+        end = schedule.find('{*}DateTimeConstraint/{*}DateTimeEnd')
+        if start is not None and end is not None:
+            try:
+                from dateutil.parser import parse
+
+                start, end = parse(start.get('value')), parse(end.get('value'))
+            except (TypeError, ValueError):
+                errors.append('Malformed observing window')
+                continue
+            if end <= start:
+                errors.append('The end of the observing window must be after the start')
+            elif end <= datetime.now(end.tzinfo):
+                errors.append('The observing window has already passed')
+    if schedules and total_count == 0:
+        errors.append('At least one exposure must be requested')
+    # The same problem is usually found in every schedule, so report it once
+    return list(dict.fromkeys(errors))
+
+
+class ScheduleTemplate:
+    """
+    The fixed Device/Exposure part of an instrument's <Schedule>, parsed once from a skeleton.
+
+    ``slots`` maps each variable value to the path of its element in the skeleton and, for values
+    held in an attribute, the attribute name. ``render()`` clones the skeleton and fills the slots.
+    The skeleton is parsed on first use rather than when the module is imported.
+    """
+    def __init__(self, skeleton, slots):
+        self._source = skeleton
+        self._slot_paths = slots
+        self._skeleton = None
+        self.slots = {}
+
+    @property
+    def skeleton(self):
+        if self._skeleton is None:
+            skeleton = etree.fromstring(self._source, etree.XMLParser(remove_blank_text=True))
+            slots = {}
+            for name, (path, attribute) in self._slot_paths.items():
+                element = skeleton.find(path)
+                # Store the child indices leading to the slot, which are cheaper to follow than a path
+                indices = []
+                while element is not skeleton:
+                    parent = element.getparent()
+                    indices.insert(0, parent.index(element))
+                    element = parent
+                slots[name] = (indices, attribute)
+            self.slots = slots
+            self._skeleton = skeleton
+        return self._skeleton
+
+    def render(self, **values):
+        schedule = copy.deepcopy(self.skeleton)
+        for name, value in values.items():
+            indices, attribute = self.slots[name]
+            element = schedule
+            for index in indices:
+                element = element[index]
+            if attribute:
+                element.set(attribute, str(value))
+            else:
+                element.text = str(value)
+        return schedule
+
+
+EXPOSURE_SLOTS = {
+    'exp_count': ('Exposure', 'count'),
+    'exp_time': ('Exposure/Value', None),
+}
+
+IOO_SCHEDULE = ScheduleTemplate('''
+    <Schedule>
+      <Device name="IO:O" type="camera">
+        <SpectralRegion>optical</SpectralRegion>
+        <Setup>
+          <Filter type=""/>
+          <Detector>
+            <Binning><X units="pixels"/><Y units="pixels"/></Binning>
+          </Detector>
+        </Setup>
+      </Device>
+      <Exposure count=""><Value units="seconds"/></Exposure>
+    </Schedule>''', dict(EXPOSURE_SLOTS, filter=('Device/Setup/Filter', 'type'),
+                         binning_x=('Device/Setup/Detector/Binning/X', None),
+                         binning_y=('Device/Setup/Detector/Binning/Y', None)))
+
+IOI_SCHEDULE = ScheduleTemplate('''
+    <Schedule>
+      <Device name="IO:I" type="camera">
+        <SpectralRegion>infrared</SpectralRegion>
+        <Setup>
+          <Filter type="H"/>
+          <Detector>
+            <Binning><X units="pixels">1</X><Y units="pixels">1</Y></Binning>
+          </Detector>
+        </Setup>
+      </Device>
+      <Exposure count=""><Value units="seconds"/></Exposure>
+    </Schedule>''', EXPOSURE_SLOTS)
+
+SPRAT_SCHEDULE = ScheduleTemplate('''
+    <Schedule>
+      <Device name="Sprat" type="spectrograph">
+        <SpectralRegion>optical</SpectralRegion>
+        <Setup>
+          <Grating name=""/>
+          <Detector>
+            <Binning><X units="pixels">1</X><Y units="pixels">1</Y></Binning>
+          </Detector>
+        </Setup>
+      </Device>
+      <Exposure count=""><Value units="seconds"/></Exposure>
+    </Schedule>''', dict(EXPOSURE_SLOTS, grating=('Device/Setup/Grating', 'name')))
+
+FRODO_SCHEDULE = ScheduleTemplate('''
+    <Schedule>
+      <Device name="" type="spectrograph">
+        <SpectralRegion>optical</SpectralRegion>
+        <Setup>
+          <Grating name=""/>
+        </Setup>
+      </Device>
+      <Exposure count=""><Value units="seconds"/></Exposure>
+    </Schedule>''', dict(EXPOSURE_SLOTS, device=('Device', 'name'), grating=('Device/Setup/Grating', 'name')))
+
+
+def built_once_per_class(method):
+    """
+    Cache the crispy layout returned by a form method on the form class, so that it is built on
+    the first instantiation only. Layout objects are only read when the form is rendered.
+    """
+    attribute = '_{0}_cache'.format(method.__name__)
+
+    @functools.wraps(method)
+    def wrapper(self):
+        cls = type(self)
+        if attribute not in cls.__dict__:
+            setattr(cls, attribute, method(self))
+        return cls.__dict__[attribute]
+    return wrapper
+
 
 class LTObservationForm(GenericObservationForm):
     project = forms.ChoiceField(choices=LT_SETTINGS['proposalIDs'], label='Proposal')
@@ -61,23 +1036,69 @@ class LTObservationForm(GenericObservationForm):
                                   label='Sky Brightness Maximum')
     photometric = forms.ChoiceField(choices=[('clear', 'Yes'), ('light', 'No')], initial='light')
 
+    cadence_interval = forms.FloatField(min_value=0.1, required=False, label='Cadence',
+                                        help_text='Repeat the observation in windows this many hours \
+                                        apart between the start and end dates. Leave empty for a \
+                                        single window.')
+    cadence_window = forms.FloatField(min_value=0.1, required=False, label='')
+    # Only shown once the visibility check has warned about the window
+    ignore_visibility = forms.BooleanField(required=False, widget=forms.HiddenInput(),
+                                           label='Submit despite the visibility warning')
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._target = None
+        self._target_template = None
+        self.visibility_warnings = []
+        self._constraint_block = None
         self.helper.layout = Layout(
             self.common_layout,
             self.layout(),
             self.extra_layout()
         )
 
+    def clean(self):
+        cleaned_data = super().clean()
+        interval, window = cleaned_data.get('cadence_interval'), cleaned_data.get('cadence_window')
+        if (interval is None) != (window is None):
+            raise forms.ValidationError('A cadence needs both an interval and a window width')
+        if interval is not None and all(cleaned_data.get(field) for field in
+                                        ('startdate', 'starttime', 'enddate', 'endtime')):
+            try:
+                windows = self.cadence_windows()
+            except ValueError:
+                raise forms.ValidationError('Malformed observing window')
+            if not windows:
+                raise forms.ValidationError('The cadence window does not fit between the start and end dates')
+            if len(windows) > LT_CADENCE_MAX_WINDOWS:
+                raise forms.ValidationError('The cadence gives {0} windows, more than the limit of {1}'.format(
+                    len(windows), LT_CADENCE_MAX_WINDOWS))
+        return cleaned_data
+
     def is_valid(self):
-        super().is_valid()
-        errors = LTFacility.validate_observation(self, self.observation_payload())
+        if not super().is_valid():
+            return False
+        problems = self.check_visibility()
+        if problems and LT_VISIBILITY_CHECK == 'block':
+            self.add_error(None, problems)
+            return False
+        self.visibility_warnings = problems
+        if problems and LT_VISIBILITY_CHECK == 'confirm' and not self.cleaned_data.get('ignore_visibility'):
+            # Hold the request back once, so the warnings are shown, until the user confirms it
+            self.fields['ignore_visibility'].widget = forms.CheckboxInput()
+            self.add_error('ignore_visibility', 'Tick to submit this request anyway')
+            return False
+        errors = LTFacility().validate_observation(self.observation_payload())
         if errors:
             self.add_error(None, errors)
         return not errors
 
+    @built_once_per_class
     def layout(self):
         return Div(
+            HTML('{% if form.visibility_warnings %}<div class="alert alert-warning">'
+                 '{% for warning in form.visibility_warnings %}<p>{{ warning }}</p>{% endfor %}</div>{% endif %}'),
+            'ignore_visibility',
             Div(
                 Div(
                     'project',
@@ -91,6 +1112,11 @@ class LTObservationForm(GenericObservationForm):
                     'enddate', 'endtime',
                     css_class='form-row'
                 ),
+                Div(
+                    PrependedAppendedText('cadence_interval', 'Every', 'hours'),
+                    PrependedAppendedText('cadence_window', 'Window', 'hours'),
+                    css_class='form-row'
+                ),
                 css_class='col-md-16'
             ),
             Div(
@@ -108,17 +1134,15 @@ class LTObservationForm(GenericObservationForm):
             css_class='form-row'
         )
 
+    @built_once_per_class
     def extra_layout(self):
         return Div()
 
     def _build_prolog(self):
-        namespaces = {
-            'xsi': LT_XSI_NS,
-        }
-        schemaLocation = etree.QName(LT_XSI_NS, 'schemaLocation')
-        uid = format(str(int(time.time())))
-        return etree.Element('RTML', {schemaLocation: LT_SCHEMA_LOCATION}, xmlns=LT_XML_NS,
-                             mode='request', uid=uid, version='3.1a', nsmap=namespaces)
+        uid = uid_generator.next()
+        uid_index.add(uid, target_id=self.cleaned_data['target_id'], project=self.cleaned_data['project'],
+                      observation_type=self.cleaned_data.get('observation_type'))
+        return build_rtml_document('request', uid)
 
     def _build_project(self, payload):
         project = etree.Element('Project', ProjectID=self.cleaned_data['project'])
@@ -142,125 +1166,234 @@ class LTObservationForm(GenericObservationForm):
         etree.SubElement(photom_const, 'Clouds').text = self.cleaned_data['photometric']
 
         date_const = etree.Element('DateTimeConstraint', type='include')
-        start = self.cleaned_data['startdate'] + 'T' + self.cleaned_data['starttime'] + ':00+00:00'
-        end = self.cleaned_data['enddate'] + 'T' + self.cleaned_data['endtime'] + ':00+00:00'
+        start, end = (time + ':00+00:00' for time in self._window())
         etree.SubElement(date_const, 'DateTimeStart', system='UT', value=start)
         etree.SubElement(date_const, 'DateTimeEnd', system='UT', value=end)
 
         return [airmass_const, sky_const, seeing_const, photom_const, date_const]
 
-    def _build_target(self):
-        target_to_observe = Target.objects.get(pk=self.cleaned_data['target_id'])
+    def _get_target(self):
+        # The target may already have been fetched for us, e.g. by LTFacility.submit_observations
+        if self._target is None:
+            self._target = Target.objects.get(pk=self.cleaned_data['target_id'])
+        return self._target
+
+    def _window(self):
+        return (self.cleaned_data['startdate'] + 'T' + self.cleaned_data['starttime'],
+                self.cleaned_data['enddate'] + 'T' + self.cleaned_data['endtime'])
+
+    def _ephemeris_windows(self, windows=None):
+        """
+        For a non-sidereal target, return the windows to request and a <Target> for each, with the
+        target's coordinates at the middle of the window. Cadence ``windows`` are kept as they are;
+        otherwise the observing window is split into sub-windows over which the target moves no
+        more than EPHEMERIS_MAX_MOTION arcseconds. The ephemeris is computed in one pass.
+        """
+        from tom_lt import lt_ephemeris
+
+        target = self._get_target()
+        with metrics.timed('ephemeris'):
+            if windows:
+                ra, dec = lt_ephemeris.ephemeris(target, [start + (end - start) / 2 for start, end in windows])
+            else:
+                start, end = self._window()
+                windows, ra, dec = lt_ephemeris.split_window(target, start, end, max_motion=LT_EPHEMERIS_MAX_MOTION,
+                                                             step=LT_EPHEMERIS_STEP,
+                                                             max_windows=LT_CADENCE_MAX_WINDOWS)
+                windows = [(start.item(), end.item()) for start, end in windows]
+        return windows, build_target_elements(target.name, ra, dec, 2000.0)
+
+    def cadence_windows(self):
+        """
+        Return the (start, end) datetimes of the cadence windows, each ``cadence_window`` hours
+        long and starting ``cadence_interval`` hours after the last, that fit between the start
+        and end of the form's observing window. Returns None when no cadence is set.
+        """
+        interval, width = self.cleaned_data.get('cadence_interval'), self.cleaned_data.get('cadence_window')
+        if not interval or not width:
+            return None
+        start, end = (datetime.strptime(time, '%Y-%m-%dT%H:%M') for time in self._window())
+        interval, width = timedelta(hours=interval), timedelta(hours=width)
+        count = int((end - start - width) / interval) + 1 if end - start >= width else 0
+        return [(start + i * interval, start + i * interval + width)
+                for i in range(min(count, LT_CADENCE_MAX_WINDOWS + 1))]
+
+    def check_visibility(self):
+        """
+        Check locally that the target gets below the maximum airmass at night during the observing
+        window, returning a list of problems. Unless VISIBILITY_CHECK is 'block' these are only
+        warnings: is_valid() keeps them in ``visibility_warnings``, which the form displays, and
+        with 'confirm' holds the request back until ``ignore_visibility`` is ticked.
+        """
+        if not LT_VISIBILITY_CHECK:
+            return []
+        from tom_lt.lt_visibility import check_window
+
+        target = self._get_target()
+        start, end = self._window()
+        try:
+            ra, dec = target.ra, target.dec
+            if target.type == Target.NON_SIDEREAL:
+                from tom_lt.lt_ephemeris import coordinates, window_middle
+
+                ra, dec = coordinates([target], window_middle(start, end))
+            with metrics.timed('visibility_check'):
+                problems = check_window(ra, dec, start, end, self.cleaned_data['max_airmass'],
+                                        LTFacility.SITES['La Palma'], step=LT_VISIBILITY_STEP,
+                                        sun_altitude=LT_NIGHT_SUN_ALTITUDE)
+        except ValueError:
+            # A malformed window is reported by check_rtml
+            return []
+        for problem in problems:
+            logger.warning('%s: %s', target.name, problem)
+        return problems
+
+    def _resolve_target(self):
+        target_to_observe = self._get_target()
+        if target_to_observe.type == Target.NON_SIDEREAL:
+            start, end = (datetime.strptime(time, '%Y-%m-%dT%H:%M') for time in self._window())
+            return self._ephemeris_windows([(start, end)])[1][0]
 
+        hours, minutes, seconds, degrees, arcminutes, arcseconds = coordinate_cache.get(target_to_observe)
         target = etree.Element('Target', name=target_to_observe.name)
-        c = SkyCoord(ra=target_to_observe.ra*u.degree, dec=target_to_observe.dec*u.degree)
         coordinates = etree.SubElement(target, 'Coordinates')
         ra = etree.SubElement(coordinates, 'RightAscension')
-        etree.SubElement(ra, 'Hours').text = str(int(c.ra.hms.h))
-        etree.SubElement(ra, 'Minutes').text = str(int(c.ra.hms.m))
-        etree.SubElement(ra, 'Seconds').text = str(c.ra.hms.s)
+        etree.SubElement(ra, 'Hours').text = hours
+        etree.SubElement(ra, 'Minutes').text = minutes
+        etree.SubElement(ra, 'Seconds').text = seconds
 
         dec = etree.SubElement(coordinates, 'Declination')
-        sign = '+' if c.dec.signed_dms.sign == '1.0' else '-'
-        etree.SubElement(dec, 'Degrees').text = sign + str(int(c.dec.signed_dms.d))
-        etree.SubElement(dec, 'Arcminutes').text = str(int(c.dec.signed_dms.m))
-        etree.SubElement(dec, 'Arcseconds').text = str(c.dec.signed_dms.s)
+        etree.SubElement(dec, 'Degrees').text = degrees
+        etree.SubElement(dec, 'Arcminutes').text = arcminutes
+        etree.SubElement(dec, 'Arcseconds').text = arcseconds
         etree.SubElement(coordinates, 'Equinox').text = str(target_to_observe.epoch)
         return target
 
-    def observation_payload(self):
-        payload = self._build_prolog()
-        self._build_project(payload)
-        self._build_inst_schedule(payload)
-        return etree.tostring(payload, encoding="unicode")
+    def _build_target(self):
+        """
+        Return a copy of the <Target> element for this form's target. The target is looked up and
+        its coordinates converted only once for the life of the form.
+        """
+        if self._target_template is None:
+            with metrics.timed('target_resolution'):
+                self._target_template = self._resolve_target()
+        return copy.deepcopy(self._target_template)
+
+    def _copy_constraints(self):
+        """
+        Return copies of the constraint elements, which are built once per observation_payload()
+        call and shared by every Schedule in the document.
+        """
+        if self._constraint_block is None:
+            self._constraint_block = self._build_constraints()
+        return copy.deepcopy(self._constraint_block)
 
+    def _build_windows(self, payload, windows, targets=None):
+        """
+        Append the instrument Schedules once per window. The Schedules are built once, with the
+        target and constraints, and then cloned for each window with only its dates changed and,
+        when ``targets`` holds a <Target> per window, its target.
+        """
+        if targets:
+            self._target_template = targets[0]
+        fragments = etree.Element('RTML')
+        self._build_inst_schedule(fragments)
+        if not len(fragments):
+            return
+        # DateTimeConstraint and Target are at the same positions in every Schedule an instrument builds
+        date_index = fragments[0].index(fragments[0].find('DateTimeConstraint'))
+        target_index = fragments[0].index(fragments[0].find('Target'))
+        for i, (start, end) in enumerate(windows):
+            start = start.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+            end = end.strftime('%Y-%m-%dT%H:%M:%S+00:00')
+            for fragment in fragments:
+                schedule = copy.deepcopy(fragment)
+                date_const = schedule[date_index]
+                date_const[0].set('value', start)
+                date_const[1].set('value', end)
+                if targets:
+                    schedule[target_index] = copy.deepcopy(targets[i])
+                payload.append(schedule)
 
-class LT_IOO_ObservationForm(LTObservationForm):
+    def observation_payload(self):
+        with metrics.timed('payload_build', form=type(self).__name__):
+            payload = self._build_prolog()
+            self._build_project(payload)
+            self._constraint_block = self._build_constraints()
+            windows = self.cadence_windows()
+            if self._get_target().type == Target.NON_SIDEREAL:
+                self._build_windows(payload, *self._ephemeris_windows(windows))
+            elif windows:
+                self._build_windows(payload, windows)
+            else:
+                self._build_inst_schedule(payload)
+        return RTMLDocument(payload)
+
+
+# The IO:O filters offered on the form, in display order, as (filter, group, label). Each one gets
+# its exposure time and count fields, a row in its group's part of the layout and, when its count
+# is non-zero, a Schedule.
+IOO_FILTERS = (
+    ('U', 'Sloan', 'u\''),
+    ('G', 'Sloan', 'g\''),
+    ('R', 'Sloan', 'r\''),
+    ('I', 'Sloan', 'i\''),
+    ('Z', 'Sloan', 'z\''),
+    ('B', 'Bessell', 'B'),
+    ('V', 'Bessell', 'V'),
+    ('Halpha6566', 'H-alpha', '6566'),
+    ('Halpha6634', 'H-alpha', '6634'),
+    ('Halpha6705', 'H-alpha', '6705'),
+    ('Halpha6755', 'H-alpha', '6755'),
+    ('Halpha6822', 'H-alpha', '6822'),
+)
+
+
+class FilterFieldsMetaclass(DeclarativeFieldsMetaclass):
+    """
+    Declare the exposure time and count fields for each filter in a form class's ``filter_table``
+    when the class is created, rather than on every instantiation.
+    """
+    def __new__(mcs, name, bases, attrs):
+        for index, (filter, group, label) in enumerate(attrs.get('filter_table', ())):
+            attrs['exp_time_' + filter] = forms.FloatField(min_value=0,
+                                                           initial=120,
+                                                           label='Integration Time' if index == 0 else '')
+            attrs['exp_count_' + filter] = forms.IntegerField(min_value=0,
+                                                              initial=0,
+                                                              label='No. of integrations' if index == 0 else '')
+        return super().__new__(mcs, name, bases, attrs)
+
+
+class LT_IOO_ObservationForm(LTObservationForm, metaclass=FilterFieldsMetaclass):
     binning = forms.ChoiceField(choices=[('1x1', '1x1'), ('2x2', '2x2')], initial=('2x2', '2x2'),
                                 help_text='2x2 binning is usual, giving 0.3 arcsec/pixel, \
                                 faster readout and lower readout noise. 1x1 binning should \
                                 only be selected if specifically required.')
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.filters = ('U',
-                        'R',
-                        'G',
-                        'I',
-                        'Z',
-                        'B',
-                        'V',
-                        'Halpha6566',
-                        'Halpha6634',
-                        'Halpha6705',
-                        'Halpha6755',
-                        'Halpha6822')
-
-        for filter in self.filters:
-            if filter == self.filters[0]:
-                self.fields['exp_time_' + filter] = forms.FloatField(min_value=0,
-                                                                     initial=120,
-                                                                     label='Integration Time')
-                self.fields['exp_count_' + filter] = forms.IntegerField(min_value=0,
-                                                                        initial=0,
-                                                                        label='No. of integrations')
-            else:
-                self.fields['exp_time_' + filter] = forms.FloatField(min_value=0,
-                                                                     initial=120,
-                                                                     label='')
-                self.fields['exp_count_' + filter] = forms.IntegerField(min_value=0,
-                                                                        initial=0,
-                                                                        label='')
+    filter_table = IOO_FILTERS
+    filters = tuple(filter for filter, group, label in IOO_FILTERS)
 
+    @built_once_per_class
     def extra_layout(self):
-        return Div(
-            Div(
-                Div(HTML('<br><h5>Sloan</h5>'), css_class='form_row'),
+        groups = OrderedDict()
+        for filter, group, label in self.filter_table:
+            groups.setdefault(group, []).append((filter, label))
+        filter_rows = []
+        for group, filters in groups.items():
+            filter_rows += [
+                Div(HTML('<br><h5>{0}</h5>'.format(group)), css_class='form_row'),
                 Div(
-                    Div(PrependedAppendedText('exp_time_U', 'u\'', 's'),
-                        PrependedAppendedText('exp_time_G', 'g\'', 's'),
-                        PrependedAppendedText('exp_time_R', 'r\'', 's'),
-                        PrependedAppendedText('exp_time_I', 'i\'', 's'),
-                        PrependedAppendedText('exp_time_Z', 'z\'', 's'),
+                    Div(*[PrependedAppendedText('exp_time_' + filter, label, 's') for filter, label in filters],
                         css_class='col-md-6', ),
-
-                    Div('exp_count_U',
-                        'exp_count_G',
-                        'exp_count_R',
-                        'exp_count_I',
-                        'exp_count_Z',
+                    Div(*['exp_count_' + filter for filter, label in filters],
                         css_class='col-md-6'),
                     css_class='form-row'
                 ),
-                Div(HTML('<br><h5>Bessell</h5>'), css_class='form_row'),
-                Div(
-                    Div(PrependedAppendedText('exp_time_B', 'B', 's'),
-                        PrependedAppendedText('exp_time_V', 'V', 's'),
-                        css_class='col-md-6', ),
-
-                    Div('exp_count_B',
-                        'exp_count_V',
-                        css_class='col-md-6'),
-                    css_class='form-row'
-                ),
-                Div(HTML('<br><h5>H-alpha</h5>'), css_class='form_row'),
-
-                Div(
-                    Div(PrependedAppendedText('exp_time_Halpha6566', '6566', 's'),
-                        PrependedAppendedText('exp_time_Halpha6634', '6634', 's'),
-                        PrependedAppendedText('exp_time_Halpha6705', '6705', 's'),
-                        PrependedAppendedText('exp_time_Halpha6755', '6755', 's'),
-                        PrependedAppendedText('exp_time_Halpha6822', '6822', 's'),
-                        css_class='col-md-6', ),
-
-                    Div('exp_count_Halpha6566',
-                        'exp_count_Halpha6634',
-                        'exp_count_Halpha6705',
-                        'exp_count_Halpha6755',
-                        'exp_count_Halpha6822',
-                        css_class='col-md-6'),
-                    css_class='form-row'
-                    ),
+            ]
+        return Div(
+            Div(
+                *filter_rows,
                 css_class='col-md-6'
             ),
             Div(css_class='col-md-1'),
@@ -278,23 +1411,12 @@ class LT_IOO_ObservationForm(LTObservationForm):
                 payload.append(self._build_schedule(filter))
 
     def _build_schedule(self, filter):
-        exp_time = self.cleaned_data['exp_time_' + filter]
-        exp_count = self.cleaned_data['exp_count_' + filter]
-
-        schedule = etree.Element('Schedule')
-        device = etree.SubElement(schedule, 'Device', name="IO:O", type="camera")
-        etree.SubElement(device, 'SpectralRegion').text = 'optical'
-        setup = etree.SubElement(device, 'Setup')
-        etree.SubElement(setup, 'Filter', type=filter)
-        detector = etree.SubElement(setup, 'Detector')
-        binning = etree.SubElement(detector, 'Binning')
-        etree.SubElement(binning, 'X', units='pixels').text = self.cleaned_data['binning'].split('x')[0]
-        etree.SubElement(binning, 'Y', units='pixels').text = self.cleaned_data['binning'].split('x')[1]
-        exposure = etree.SubElement(schedule, 'Exposure', count=str(exp_count))
-        etree.SubElement(exposure, 'Value', units='seconds').text = str(exp_time)
+        binning_x, binning_y = self.cleaned_data['binning'].split('x')
+        schedule = IOO_SCHEDULE.render(filter=filter, binning_x=binning_x, binning_y=binning_y,
+                                       exp_count=self.cleaned_data['exp_count_' + filter],
+                                       exp_time=self.cleaned_data['exp_time_' + filter])
         schedule.append(self._build_target())
-        for const in self._build_constraints():
-            schedule.append(const)
+        schedule.extend(self._copy_constraints())
         return schedule
 
 
@@ -305,6 +1427,7 @@ class LT_IOI_ObservationForm(LTObservationForm):
                                    help_text='The Liverpool Telescope will automatically \
                                    create a dither pattern between exposures.')
 
+    @built_once_per_class
     def extra_layout(self):
         return Div(
             Div(
@@ -321,23 +1444,10 @@ class LT_IOI_ObservationForm(LTObservationForm):
         )
 
     def _build_inst_schedule(self, payload):
-        exp_time = self.cleaned_data['exp_time']
-        exp_count = self.cleaned_data['exp_count']
-
-        schedule = etree.Element('Schedule')
-        device = etree.SubElement(schedule, 'Device', name="IO:I", type="camera")
-        etree.SubElement(device, 'SpectralRegion').text = 'infrared'
-        setup = etree.SubElement(device, 'Setup')
-        etree.SubElement(setup, 'Filter', type='H')
-        detector = etree.SubElement(setup, 'Detector')
-        binning = etree.SubElement(detector, 'Binning')
-        etree.SubElement(binning, 'X', units='pixels').text = '1'
-        etree.SubElement(binning, 'Y', units='pixels').text = '1'
-        exposure = etree.SubElement(schedule, 'Exposure', count=str(exp_count))
-        etree.SubElement(exposure, 'Value', units='seconds').text = str(exp_time)
+        schedule = IOI_SCHEDULE.render(exp_count=self.cleaned_data['exp_count'],
+                                       exp_time=self.cleaned_data['exp_time'])
         schedule.append(self._build_target())
-        for const in self._build_constraints():
-            schedule.append(const)
+        schedule.extend(self._copy_constraints())
         payload.append(schedule)
 
 
@@ -348,6 +1458,7 @@ class LT_SPRAT_ObservationForm(LTObservationForm):
 
     grating = forms.ChoiceField(choices=[('red', 'Red'), ('blue', 'Blue')], initial='red')
 
+    @built_once_per_class
     def extra_layout(self):
         return Div(
                     Div(PrependedAppendedText('exp_time', 'SPRAT', 's'), css_class='col'),
@@ -357,24 +1468,11 @@ class LT_SPRAT_ObservationForm(LTObservationForm):
                     )
 
     def _build_inst_schedule(self, payload):
-        exp_time = self.cleaned_data['exp_time']
-        exp_count = self.cleaned_data['exp_count']
-        grating = self.cleaned_data['grating']
-
-        schedule = etree.Element('Schedule')
-        device = etree.SubElement(schedule, 'Device', name="Sprat", type="spectrograph")
-        etree.SubElement(device, 'SpectralRegion').text = 'optical'
-        setup = etree.SubElement(device, 'Setup')
-        etree.SubElement(setup, 'Grating', name=grating)
-        detector = etree.SubElement(setup, 'Detector')
-        binning = etree.SubElement(detector, 'Binning')
-        etree.SubElement(binning, 'X', units='pixels').text = '1'
-        etree.SubElement(binning, 'Y', units='pixels').text = '1'
-        exposure = etree.SubElement(schedule, 'Exposure', count=str(exp_count))
-        etree.SubElement(exposure, 'Value', units='seconds').text = str(exp_time)
+        schedule = SPRAT_SCHEDULE.render(grating=self.cleaned_data['grating'],
+                                         exp_count=self.cleaned_data['exp_count'],
+                                         exp_time=self.cleaned_data['exp_time'])
         schedule.append(self._build_target())
-        for const in self._build_constraints():
-            schedule.append(const)
+        schedule.extend(self._copy_constraints())
         payload.append(schedule)
 
 
@@ -389,6 +1487,7 @@ class LT_FRODO_ObservationForm(LTObservationForm):
     exp_count_red = forms.IntegerField(min_value=0, initial=1, label='')
     res_red = forms.ChoiceField(choices=[('high', 'High'), ('low', 'Low')], initial='low', label='')
 
+    @built_once_per_class
     def extra_layout(self):
         return Div(
                     Div(PrependedAppendedText('exp_time_blue', 'Blue Arm', 's'),
@@ -410,16 +1509,9 @@ class LT_FRODO_ObservationForm(LTObservationForm):
                                             str(self.cleaned_data['exp_time_red'])))
 
     def _build_schedule(self, device, grating, exp_count, exp_time):
-        schedule = etree.Element('Schedule')
-        device = etree.SubElement(schedule, 'Device', name=device, type="spectrograph")
-        etree.SubElement(device, 'SpectralRegion').text = 'optical'
-        setup = etree.SubElement(device, 'Setup')
-        etree.SubElement(setup, 'Grating', name=grating)
-        exposure = etree.SubElement(schedule, 'Exposure', count=exp_count)
-        etree.SubElement(exposure, 'Value', units='seconds').text = exp_time
+        schedule = FRODO_SCHEDULE.render(device=device, grating=grating, exp_count=exp_count, exp_time=exp_time)
         schedule.append(self._build_target())
-        for const in self._build_constraints():
-            schedule.append(const)
+        schedule.extend(self._copy_constraints())
         return schedule
 
 
@@ -447,97 +1539,437 @@ class LTFacility(GenericObservationFacility):
         else:
             return LT_IOO_ObservationForm
 
+    def _send_rtml(self, observation_payload):
+        return call_node_agent(RTMLDocument.parse(observation_payload))
+
     def submit_observation(self, observation_payload):
+        documents = RTMLDocument.parse(observation_payload).batches(LT_CADENCE_BATCH_SIZE)
+        if len(documents) > 1:
+            # A long cadence, sent as several documents of at most CADENCE_BATCH_SIZE Schedules
+            if LT_SETTINGS['DEBUG'] or LT_SETTINGS.get('QUEUED'):
+                return [obs_id for document in documents for obs_id in self.submit_observation(document)]
+            # Batches the telescope accepted are kept even if others failed, since they are already
+            # scheduled; the failures are logged and kept in self.submission_errors
+            obs_ids = []
+            self.submission_errors = []
+            for document, response_rtml in zip(documents, call_node_agent_many(documents)):
+                if not isinstance(response_rtml, Exception) and response_rtml.rejected:
+                    response_rtml = RTMLRejectError(
+                        'The Liverpool Telescope rejected request {0}'.format(response_rtml.get('uid')))
+                if isinstance(response_rtml, Exception):
+                    logger.error('Cadence batch %s of %d failed: %s', document.element.get('uid'), len(documents),
+                                 response_rtml)
+                    self.submission_errors.append(response_rtml)
+                else:
+                    obs_ids.append(response_rtml.get('uid'))
+            if not obs_ids:
+                raise self.submission_errors[0]
+            return obs_ids
         if(LT_SETTINGS['DEBUG']):
-            payload = etree.fromstring(observation_payload)
-            f = open("created.rtml", "w")
-            f.write(etree.tostring(payload, encoding="unicode", pretty_print=True))
-            f.close()
+            document = RTMLDocument.parse(observation_payload)
+            rtml_archive.record(document.element.get('uid'), document.pretty())
             return [0]
+        elif LT_SETTINGS.get('QUEUED'):
+            # Hand the payload to the tom_lt.lt_queue worker rather than waiting on the node agent
+            return [lt_queue.enqueue(str(observation_payload))]
         else:
-            headers = {
-                'Username': LT_SETTINGS['username'],
-                'Password': LT_SETTINGS['password']
-            }
-            url = '{0}://{1}:{2}/node_agent2/node_agent?wsdl'.format('http', LT_SETTINGS['LT_HOST'],
-                                                                     LT_SETTINGS['LT_PORT'])
-            client = Client(url=url, headers=headers)
-            # Send payload, and receive response string, removing the encoding tag which causes issue with lxml parsing
-            response = client.service.handle_rtml(observation_payload).replace('encoding="ISO-8859-1"', '')
-            response_rtml = etree.fromstring(response)
-            mode = response_rtml.get('mode')
-            if mode == 'reject':
-                self.dump_request_response(observation_payload, response_rtml)
+            response_rtml = self._send_rtml(observation_payload)
+            if response_rtml.rejected:
+                raise RTMLRejectError('The Liverpool Telescope rejected request {0}'.format(response_rtml.get('uid')))
             obs_id = response_rtml.get('uid')
             return [obs_id]
 
+    def submit_observations(self, targets, config):
+        """
+        Submit the same instrument configuration for many targets in one go.
+
+        ``targets`` is an iterable of Target instances or primary keys, and ``config`` is the form data
+        shared by every request, including the ``observation_type``. The targets are fetched with a
+        single query and the requests are sent together through the node agent transport, which runs
+        TRANSPORT_CONCURRENCY of them at a time. Returns one dict per target, in order, holding either
+        its ``observation_id`` or the ``errors`` that stopped it, and any visibility ``warnings``. With
+        QUEUED set, the requests are stored in the submission queue and their pending ids returned
+        instead.
+        """
+        target_ids = [getattr(target, 'pk', target) for target in targets]
+        resolved = Target.objects.in_bulk(target_ids)
+        form_class = self.get_form(config.get('observation_type'))
+
+        results = []
+        pending = []
+        for target_id in target_ids:
+            result = {'target_id': target_id}
+            results.append(result)
+            if target_id not in resolved:
+                result['errors'] = ['Target {0} does not exist'.format(target_id)]
+                continue
+            form = form_class(dict(config, target_id=target_id, facility=self.name))
+            form._target = resolved[target_id]
+            # Skip LTObservationForm.is_valid, which would ask the node agent about every target
+            if not super(LTObservationForm, form).is_valid():
+                result['errors'] = [error for errors in form.errors.values() for error in errors]
+                continue
+            observation_payload = form.observation_payload()
+            errors = check_rtml(observation_payload.element)
+            if errors:
+                result['errors'] = errors
+                continue
+            pending.append((result, observation_payload))
+
+        if pending and LT_VISIBILITY_CHECK:
+            # One vectorised check for every target, rather than one per form
+            start, end = form._window()
+            visible = self.check_visibility([resolved[result['target_id']] for result, _ in pending],
+                                            start, end, form.cleaned_data['max_airmass'])
+            problem = 'The target never gets below airmass {0} at night during the observing window'.format(
+                form.cleaned_data['max_airmass'])
+            for (result, _), visibility in zip(pending, visible):
+                if not visibility['observable']:
+                    result['errors' if LT_VISIBILITY_CHECK == 'block' else 'warnings'] = [problem]
+            pending = [(result, payload) for result, payload in pending if 'errors' not in result]
+
+        if LT_SETTINGS['DEBUG'] or LT_SETTINGS.get('QUEUED'):
+            for result, observation_payload in pending:
+                result['observation_id'] = self.submit_observation(observation_payload)[0]
+            return results
+        responses = call_node_agent_many(observation_payload for _, observation_payload in pending)
+        for (result, _), response_rtml in zip(pending, responses):
+            if isinstance(response_rtml, Exception):
+                result['errors'] = ['Error with connection to Liverpool Telescope: {0}'.format(response_rtml)]
+            elif response_rtml.rejected:
+                result['errors'] = ['Error with RTML submission to Liverpool Telescope']
+            else:
+                result['observation_id'] = response_rtml.get('uid')
+        return results
+
+    def check_visibility(self, targets, start, end, max_airmass=2):
+        """
+        Check which of many targets can be observed from La Palma between ``start`` and ``end``
+        (ISO 8601 strings or datetimes, UT) at no more than ``max_airmass``, with the sun below
+        NIGHT_SUN_ALTITUDE.
+
+        ``targets`` is an iterable of Target instances or primary keys; primary keys are fetched
+        with a single query. All the targets are checked in one vectorised computation. Returns
+        one dict per target, in order, with its ``target_id``, whether it is ``observable``, the
+        ``minutes`` it is observable for, the ``min_airmass`` it reaches at night and the
+        ``first`` time it is observable (None if never).
+        """
+        from tom_lt.lt_ephemeris import coordinates, window_middle
+        from tom_lt.lt_visibility import visibility
+
+        targets = list(targets)
+        ids = [target for target in targets if not isinstance(target, Target)]
+        fetched = Target.objects.in_bulk(ids) if ids else {}
+        targets = [target if isinstance(target, Target) else fetched[target] for target in targets]
+        with metrics.timed('visibility_check', targets=len(targets)):
+            # Non-sidereal targets are checked at their position in the middle of the window
+            ra, dec = coordinates(targets, window_middle(start, end))
+            result = visibility(ra, dec, start, end, max_airmass, self.SITES['La Palma'], step=LT_VISIBILITY_STEP,
+                                sun_altitude=LT_NIGHT_SUN_ALTITUDE)
+        return [{
+            'target_id': target.pk,
+            'observable': bool(result['observable'][i]),
+            'minutes': int(result['minutes'][i]),
+            'min_airmass': float(result['min_airmass'][i]),
+            'first': result['first'][i].item(),
+        } for i, target in enumerate(targets)]
+
     def cancel_observation(self, observation_id):
-        form = self.get_form()()
-        payload = form._build_prolog()
-        payload.append(form._build_project())
+        """
+        Ask the node agent to abort an observation, returning whether it was cancelled. Queued
+        submissions that have not been sent yet are withdrawn from the queue instead, and ones the
+        queue worker has sent are aborted under the uid they were submitted with.
+        """
+        observation_id = str(observation_id)
+        if lt_queue.is_pending(observation_id):
+            withdrawn, observation_id = self._withdraw_pending(observation_id)
+            if withdrawn or observation_id is None:
+                return withdrawn
+        if LT_SETTINGS['DEBUG']:
+            return True
+        return self._abort_confirmed(observation_id, call_node_agent(build_cancel_document(observation_id)))
+
+    def _withdraw_pending(self, pending_id):
+        """
+        Withdraw a queued submission, returning (True, None) if it was taken off the queue, or
+        otherwise (False, uid) with the uid the worker submitted it under (None while it is still
+        being sent).
+        """
+        if lt_queue.cancel(pending_id):
+            return True, None
+        return False, lt_queue.submitted_id(pending_id)
+
+    def _abort_confirmed(self, observation_id, response_rtml):
+        canceled = response_rtml.get('mode') == 'abort' and not response_rtml.rejected
+        if canceled:
+            caches[LT_VALIDATION_CACHE].delete('tom_lt.status.' + observation_id)
+        return canceled
+
+    def cancel_observations(self, observation_ids):
+        """
+        Cancel many observations at once, sending the abort documents together through the node
+        agent transport. Returns one dict per id, in order, with its ``observation_id``, whether it
+        was ``canceled`` and any ``errors``.
+        """
+        results = []
+        remote = []
+        for observation_id in observation_ids:
+            result = {'observation_id': observation_id, 'canceled': False}
+            results.append(result)
+            uid = str(observation_id)
+            if lt_queue.is_pending(uid):
+                result['canceled'], uid = self._withdraw_pending(uid)
+                if uid is None:
+                    continue
+            if LT_SETTINGS['DEBUG']:
+                result['canceled'] = True
+            else:
+                remote.append((result, uid))
 
-    def validate_observation(self, observation_payload):
+        projects = project_ids(uid for _, uid in remote)
+        responses = call_node_agent_many(build_cancel_document(uid, projects.get(uid, '')) for _, uid in remote)
+        for (result, uid), response_rtml in zip(remote, responses):
+            if isinstance(response_rtml, Exception):
+                result['errors'] = ['Error with connection to Liverpool Telescope: {0}'.format(response_rtml)]
+            else:
+                result['canceled'] = self._abort_confirmed(uid, response_rtml)
+        for result in results:
+            if not result['canceled'] and 'errors' not in result:
+                result['errors'] = ['The Liverpool Telescope did not cancel the observation']
+        return results
+
+    def validate_observation(self, observation_payload, remote=False):
+        """
+        Validate the payload locally, only asking the node agent for an offer when ``remote`` is set
+        or when the last offer it made for the same proposal is older than LT_INQUIRY_FRESHNESS. With
+        QUEUED set only the local checks are made, unless ``remote`` is set, so that web workers
+        never wait on the node agent.
+        """
         if(LT_SETTINGS['DEBUG']):
             return []
         else:
-            headers = {
-                'Username': LT_SETTINGS['username'],
-                'Password': LT_SETTINGS['password']
-            }
-            url = '{0}://{1}:{2}/node_agent2/node_agent?wsdl'.format('http',
-                                                                     LT_SETTINGS['LT_HOST'],
-                                                                     LT_SETTINGS['LT_PORT'])
-            client = Client(url=url, headers=headers)
-            validate_payload = etree.fromstring(observation_payload)
-            # Change the payload to an inquiry mode document to test connectivity.
-            validate_payload.set('mode', 'inquiry')
-            # Send payload, and receive response string, removing the encoding tag which causes issue with lxml parsing
-            print("Trying")
+            document = RTMLDocument.parse(observation_payload)
+            errors = check_rtml(document.element)
+            if errors or (LT_SETTINGS.get('QUEUED') and not remote):
+                return errors
+            cache = caches[LT_VALIDATION_CACHE]
+            cache_key = 'tom_lt.validation.' + rtml_digest(document.element)
+            verdict = cache.get(cache_key)
+            if not remote and verdict is not None:
+                return verdict
+            offer_key = client_pool._key(LT_SETTINGS) + (document.element.find('{*}Project').get('ProjectID'),)
+            last_offer = _last_offers.get(offer_key)
+            if not remote and last_offer is not None and time.monotonic() - last_offer < LT_INQUIRY_FRESHNESS:
+                return []
+
+            # Send the payload as an inquiry mode document to test connectivity.
+            inquiry = document.inquiry()
+            logger.debug('Sending inquiry %s to the Liverpool Telescope', inquiry.element.get('uid'))
             try:
-                response = client.service.handle_rtml(validate_payload).replace('encoding="ISO-8859-1"', '')
-            except:
+                response_rtml = call_node_agent(inquiry, idempotent=True)
+            except Exception:
                 return ['Error with connection to Liverpool Telescope',
                         'This could be due to incorrect credentials, or IP / Port settings',
                         'Occassionally, this could be due to the rebooting of systems at the Telescope Site',
                         'Please retry at another time.',
                         'If the problem persists please contact ltsupport_astronomer@ljmu.ac.uk']
 
-            response_rtml = etree.fromstring(response)
-            print("HERE", response)
+            logger.debug('Inquiry %s answered with mode %s', inquiry.element.get('uid'), response_rtml.get('mode'))
             if response_rtml.get('mode') == 'offer':
-                self.dump_request_response()(observation_payload, response)
+                _last_offers[offer_key] = time.monotonic()
+                cache.set(cache_key, [], LT_VALIDATION_CACHE_TTL)
                 return []
-            elif response_rtml.get('type') == 'reject':
-                self.dump_request_response()(observation_payload, response)
-                return ['Error with RTML submission to Liverpool Telescope',
-                        'This can occassionally happen due to systems rebooting at the Telescope Site',
-                        'Please retry at another time.',
-                        'If the problem persists please contact ltsupport_astronomer@ljmu.ac.uk']
-
-    def dump_request_response(self, observation_payload, response):
+            elif response_rtml.rejected:
+                logger.info('Inquiry %s rejected, see the RTML archive', inquiry.element.get('uid'))
+                errors = ['Error with RTML submission to Liverpool Telescope',
+                          'This can occassionally happen due to systems rebooting at the Telescope Site',
+                          'Please retry at another time.',
+                          'If the problem persists please contact ltsupport_astronomer@ljmu.ac.uk']
+                cache.set(cache_key, errors, LT_VALIDATION_CACHE_TTL)
+                return errors
+
+    def get_node_agent_state(self):
         """
-        Function to dump the payload and response form the telescope
-        for debugging / user support issues
+        Report the circuit breaker state ('closed', 'open' or 'half-open') and failure count.
         """
-        print("dump_request_response called")
-        f = open("dump", "w")
-        f.write("DUMP")
-        f.write(etree.tostring(observation_payload, encoding="unicode", pretty_print=True))
-        f.write(etree.tostring(response, encoding="unicode", pretty_print=True))
-        f.close()
-        return
+        return node_agent_breaker.stats()
 
     def get_observation_url(self, observation_id):
         return ''
 
     def get_terminal_observing_states(self):
-        return ['IN_PROGRESS', 'COMPLETED']
+        return ['COMPLETED', 'FAILED', 'CANCELED']
 
     def get_observing_sites(self):
         return self.SITES
 
     def get_observation_status(self, observation_id):
-        return
+        return self.get_observation_statuses([observation_id])[str(observation_id)]
+
+    def get_observation_statuses(self, observation_ids, partial=False):
+        """
+        Fetch the status of many observations at once, returning a dict keyed by observation id.
+
+        Statuses are cached for STATUS_CACHE_TTL seconds, and the ones not in the cache are fetched
+        together through the node agent transport. The number of node agent calls made is kept in
+        ``self.status_calls``. If any call fails its error is raised, unless ``partial`` is set, in
+        which case the ids whose calls failed are left out of the result and their errors are kept
+        in ``self.status_failures``.
+
+        Pending ids from the submission queue take the state of their queued submission and, once
+        the worker has sent it, the status of the uid it was submitted under. Those uids are kept
+        in ``self.submitted_ids``, keyed by pending id.
+        """
+        cache = caches[LT_VALIDATION_CACHE]
+        observation_ids = list(dict.fromkeys(str(observation_id) for observation_id in observation_ids))
+        queued = lt_queue.states([observation_id for observation_id in observation_ids
+                                  if lt_queue.is_pending(observation_id)])
+        statuses = {}
+        self.submitted_ids = {}
+        # The uid whose status each observation takes
+        uids = {}
+        for observation_id in observation_ids:
+            if not lt_queue.is_pending(observation_id):
+                uids[observation_id] = observation_id
+                continue
+            state, submitted_id = queued.get(observation_id, (lt_queue.QUEUED, None))
+            if state == lt_queue.SUBMITTED and submitted_id:
+                self.submitted_ids[observation_id] = uids[observation_id] = submitted_id
+            else:
+                statuses[observation_id] = {'state': LT_QUEUE_STATES.get(state, 'PENDING'),
+                                            'scheduled_start': None, 'scheduled_end': None}
+        keys = {uid: 'tom_lt.status.' + uid for uid in uids.values()}
+        cached = cache.get_many(keys.values())
+        to_fetch = [uid for uid in keys if keys[uid] not in cached]
+
+        self.status_calls = 0
+        self.status_failures = {}
+        failures = {}
+        fetched = {}
+        if to_fetch and not LT_SETTINGS['DEBUG']:
+            self.status_calls = len(to_fetch)
+            responses = call_node_agent_many((build_status_inquiry(uid) for uid in to_fetch), idempotent=True)
+            for uid, response_rtml in zip(to_fetch, responses):
+                if isinstance(response_rtml, Exception):
+                    failures[uid] = response_rtml
+                    continue
+                fetched[keys[uid]] = {
+                    'state': LT_RTML_MODE_STATES.get(response_rtml.get('mode'), 'PENDING'),
+                    'scheduled_start': None,
+                    'scheduled_end': None,
+                }
+            cache.set_many(fetched, LT_STATUS_CACHE_TTL)
+            if failures and not partial:
+                raise next(iter(failures.values()))
+        for observation_id, uid in uids.items():
+            if uid in failures:
+                self.status_failures[observation_id] = failures[uid]
+                continue
+            status = fetched.get(keys[uid]) or cached.get(keys[uid])
+            statuses[observation_id] = status or {'state': 'PENDING', 'scheduled_start': None, 'scheduled_end': None}
+        return {observation_id: statuses[observation_id] for observation_id in observation_ids
+                if observation_id in statuses}
+
+    def update_all_observation_statuses(self, target=None):
+        """
+        Refresh every non-terminal LT observation with one batched status fetch. The statuses that
+        were fetched are applied even if some calls failed; the failed ids are returned with their
+        errors.
+        """
+        from tom_common.hooks import run_hook
+        from tom_observations.models import ObservationRecord
+
+        records = ObservationRecord.objects.filter(facility=self.name)
+        if target:
+            records = records.filter(target=target)
+        records = list(records.exclude(status__in=self.get_terminal_observing_states()))
+        statuses = self.get_observation_statuses((record.observation_id for record in records), partial=True)
+        logger.info('Refreshed %d LT observations with %d node agent calls', len(records), self.status_calls)
+
+        failed = []
+        for record in records:
+            if str(record.observation_id) in self.status_failures:
+                failed.append((record.observation_id, str(self.status_failures[str(record.observation_id)])))
+                continue
+            status = statuses[str(record.observation_id)]
+            submitted_id = self.submitted_ids.get(str(record.observation_id))
+            if submitted_id is None and record.status == status['state']:
+                continue
+            previous_status = record.status
+            if submitted_id is not None:
+                # Sent by the queue worker, but the record still holds its pending id
+                record.observation_id = submitted_id
+            record.status = status['state']
+            record.save()
+            if previous_status != record.status:
+                run_hook('observation_change_state', record, previous_status)
+        return failed
 
     def data_products(self, observation_id, product_id=None):
-        return []
+        """
+        List the frames of an observation from the ImageData entries in the node agent's
+        response to a status inquiry.
+        """
+        if LT_SETTINGS['DEBUG'] or lt_queue.is_pending(observation_id):
+            return []
+        response_rtml = call_node_agent(build_status_inquiry(observation_id), idempotent=True)
+
+        products = []
+        for image_data in response_rtml.iter('ImageData'):
+            url = (image_data.text or '').strip()
+            if not url:
+                continue
+            filename = url.rstrip('/').rsplit('/', 1)[-1]
+            if product_id is not None and filename != product_id:
+                continue
+            products.append({'id': filename, 'filename': filename, 'url': url, 'created': None})
+        return products
+
+    def save_data_products(self, observation_record, product_id=None):
+        """
+        Stream the frames of an observation into MEDIA_ROOT, several at a time, resuming any
+        interrupted downloads, and return its DataProducts. A DataProduct is only created once its
+        file has downloaded; frames that failed to download are left out and retried next time.
+        """
+        from tom_dataproducts.models import DataProduct, data_product_path
+        from tom_dataproducts.utils import create_image_dataproduct
+
+        products = self.data_products(observation_record.observation_id, product_id)
+        existing = {dp.product_id: dp for dp in DataProduct.objects.filter(
+            target=observation_record.target, observation_record=observation_record,
+            product_id__in=[product['id'] for product in products])}
+        files = []
+        for product in products:
+            dp = existing.get(product['id'])
+            if dp is not None and dp.data:
+                continue
+            if dp is None:
+                dp = DataProduct(product_id=product['id'], target=observation_record.target,
+                                 observation_record=observation_record)
+            relative_path = data_product_path(dp, product['filename'])
+            files.append({'url': product['url'],
+                          'path': os.path.join(settings.MEDIA_ROOT, relative_path),
+                          'relative_path': relative_path,
+                          'data_product': dp})
+
+        results = lt_download.download_all(files, max_workers=LT_MAX_CONCURRENT_DOWNLOADS,
+                                           chunk_size=LT_DOWNLOAD_CHUNK_SIZE, timeout=LT_DOWNLOAD_TIMEOUT)
+        for file, error in results:
+            if error is None:
+                dp = file['data_product']
+                dp.data.name = file['relative_path']
+                dp.save()
+                existing[dp.product_id] = dp
+                logger.info('Saved new dataproduct: %s', dp.data)
+
+        final_products = []
+        for product in products:
+            dp = existing.get(product['id'])
+            if dp is None or not dp.data:
+                continue
+            # As GenericObservationFacility does, so LT frames get thumbnails and previews too
+            if getattr(settings, 'AUTO_THUMBNAILS', False):
+                create_image_dataproduct(dp)
+                dp.get_preview()
+            final_products.append(dp)
+        return final_products
@@ -0,0 +1,143 @@
+"""
+Append-only, compressed archive of every RTML exchange with the Liverpool Telescope node agent.
+
+Exchanges are handed to a background thread, so recording one never blocks a request. The
+writer batches whatever has queued up into a single gzip member appended to the current archive
+file, one JSON record per line. Files rotate daily or once they reach ``max_bytes``. An SQLite
+index maps each uid to the file, member offset and line of its records, so any past exchange
+can be pulled up without scanning the archive. At most ``max_backlog`` exchanges wait to be
+written; beyond that, and whenever the archive cannot be written, exchanges are dropped and
+logged rather than held in memory:
+
+    archive.lookup('1792290639185398980000')
+"""
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class RTMLArchive:
+    def __init__(self, directory, max_bytes=10 * 1024 * 1024, max_backlog=10000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_backlog)
+        self._thread = None
+        self._lock = threading.Lock()
+        self._current = None
+
+    def record(self, uid, request, response=None):
+        """
+        Queue an exchange for archiving. ``request`` and ``response`` are RTML strings.
+        """
+        try:
+            self._queue.put_nowait({'uid': uid, 'time': time.time(), 'request': request, 'response': response})
+        except queue.Full:
+            self.dropped += 1
+            logger.warning('RTML archive backlog is full, dropping exchange %s', uid)
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='lt-rtml-archive', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush)
+
+    @property
+    def backlog(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        """
+        Block until everything queued so far has been written.
+        """
+        if self._thread is not None:
+            self._queue.join()
+
+    def _connect(self):
+        connection = sqlite3.connect(os.path.join(self.directory, 'index.sqlite3'), timeout=30)
+        connection.execute('CREATE TABLE IF NOT EXISTS exchange (uid TEXT, file TEXT, offset INTEGER, '
+                           'length INTEGER, line INTEGER)')
+        connection.execute('CREATE INDEX IF NOT EXISTS exchange_uid ON exchange (uid)')
+        return connection
+
+    def _archive_file(self):
+        day = time.strftime('%Y%m%d', time.gmtime())
+        if self._current is not None and self._current.startswith('rtml-' + day):
+            path = os.path.join(self.directory, self._current)
+            if not os.path.exists(path) or os.path.getsize(path) < self.max_bytes:
+                return self._current
+        existing = [name for name in os.listdir(self.directory) if name.startswith('rtml-' + day)]
+        part = len(existing)
+        if existing:
+            latest = 'rtml-{0}-{1:03d}.jsonl.gz'.format(day, part - 1)
+            if os.path.getsize(os.path.join(self.directory, latest)) < self.max_bytes:
+                part -= 1
+        self._current = 'rtml-{0}-{1:03d}.jsonl.gz'.format(day, part)
+        return self._current
+
+    def _write(self, connection, records):
+        name = self._archive_file()
+        lines = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+        member = gzip.compress(lines)
+        with open(os.path.join(self.directory, name), 'ab') as f:
+            offset = f.tell()
+            f.write(member)
+        connection.executemany('INSERT INTO exchange VALUES (?, ?, ?, ?, ?)',
+                               [(record['uid'], name, offset, len(member), line)
+                                for line, record in enumerate(records)])
+        connection.commit()
+
+    def _run(self):
+        connection = None
+        while True:
+            records = [self._queue.get()]
+            # Write everything that has queued up meanwhile as one gzip member
+            while True:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                # Set up on the first write, and again after a failure, so that an archive directory
+                # that cannot be created drops records instead of stopping the writer
+                if connection is None:
+                    os.makedirs(self.directory, exist_ok=True)
+                    connection = self._connect()
+                self._write(connection, records)
+            except Exception:
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                logger.exception('Failed to archive %d RTML exchanges', len(records))
+            finally:
+                for _ in records:
+                    self._queue.task_done()
+
+    def lookup(self, uid):
+        """
+        Return every archived exchange with the given uid, oldest first.
+        """
+        self.flush()
+        if not os.path.exists(os.path.join(self.directory, 'index.sqlite3')):
+            return []
+        connection = self._connect()
+        try:
+            rows = connection.execute('SELECT file, offset, length, line FROM exchange WHERE uid = ? ORDER BY rowid',
+                                      (str(uid),)).fetchall()
+        finally:
+            connection.close()
+        exchanges = []
+        for name, offset, length, line in rows:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                f.seek(offset)
+                member = gzip.decompress(f.read(length))
+            exchanges.append(json.loads(member.splitlines()[line]))
+        return exchanges
@@ -0,0 +1,296 @@
+"""
+Benchmarks for the Liverpool Telescope facility, run against the local node agent stand-in
+(tom_lt.lt_node_agent) so that no telescope is needed:
+
+    python -m tom_lt.lt_bench [--requests 200] [--concurrency 4] [--latency 0.0]
+
+Reports the import time and resident memory of the facility modules in a fresh interpreter, the
+cost of building a suds client from scratch against checking one out of the pool, the time taken
+to construct and render each instrument form, the time taken to build a 500 window cadence,
+the rate at which IO:O Schedule elements are generated element by element and from the
+precompiled template, node agent calls per second through the suds and asyncio transports and,
+for each instrument form, submissions per second with p50/p99 latency of a full form -> payload
+-> handle_rtml round trip.
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+HEAVY_MODULES = ('astropy.coordinates', 'suds', 'lxml.etree', 'dateutil.parser')
+
+# Run in a fresh interpreter, so that the import is measured cold after django.setup()
+STARTUP_SCRIPT = '''
+import json, resource, sys, time
+import django
+django.setup()
+before = set(sys.modules)
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+import {module}
+print(json.dumps({{
+    'import_ms': (time.perf_counter() - start) * 1000,
+    'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+    'heavy': [name for name in {heavy!r} if name in sys.modules and name not in before],
+}}))
+'''
+
+INSTRUMENT_DATA = {
+    # form_data() adds an exposure in each of the filters in tom_lt.lt.IOO_FILTERS
+    'IOO': {'binning': '2x2'},
+    'IOI': {'exp_time': 60, 'exp_count': 5},
+    'SPRAT': {'exp_time': 300, 'exp_count': 1, 'grating': 'red'},
+    'FRODO': {'exp_time_blue': 120, 'exp_count_blue': 1, 'res_blue': 'low',
+              'exp_time_red': 120, 'exp_count_red': 1, 'res_red': 'high'},
+}
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(round(q / 100 * (len(samples) - 1))))]
+
+
+def form_data(observation_type, target, project):
+    from tom_lt.lt import IOO_FILTERS
+
+    start = date.today() + timedelta(days=1)
+    data = {
+        'facility': 'LT', 'observation_type': observation_type, 'target_id': target.pk,
+        'project': project, 'startdate': start.isoformat(), 'starttime': '12:00',
+        'enddate': (start + timedelta(days=2)).isoformat(), 'endtime': '12:00',
+        'max_airmass': 2, 'max_seeing': 1.2, 'max_skybri': 1, 'photometric': 'light',
+    }
+    data.update(INSTRUMENT_DATA[observation_type])
+    if observation_type == 'IOO':
+        for filter, _, _ in IOO_FILTERS:
+            data.update({'exp_time_' + filter: 30, 'exp_count_' + filter: 1})
+    return data
+
+
+def build_payload(facility, data, target):
+    from tom_lt.lt import LTObservationForm
+
+    form = facility.get_form(data['observation_type'])(data)
+    form._target = target
+    # Skip the node agent inquiry in LTObservationForm.is_valid; only the submission is measured
+    if not super(LTObservationForm, form).is_valid():
+        raise ValueError(form.errors)
+    return form.observation_payload()
+
+
+def bench_startup(module):
+    """
+    Import ``module`` in a new interpreter and report the time taken, the growth in peak resident
+    memory and which of HEAVY_MODULES the import loaded.
+    """
+    script = STARTUP_SCRIPT.format(module=module, heavy=HEAVY_MODULES)
+    # The child needs the same settings module and import path as this process
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    output = subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.PIPE, env=env).stdout
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def bench_forms(facility, n=200):
+    """
+    Time constructing an unbound form for each instrument, and rendering it with crispy forms.
+    """
+    from crispy_forms.utils import render_crispy_form
+
+    results = {}
+    for observation_type in INSTRUMENT_DATA:
+        form_class = facility.get_form(observation_type)
+        # The first instantiation builds the per-class layout, so leave it out of the timings
+        render_crispy_form(form_class())
+        start = time.perf_counter()
+        for _ in range(n):
+            form_class()
+        construct = (time.perf_counter() - start) / n
+        start = time.perf_counter()
+        for _ in range(n // 10 or 1):
+            render_crispy_form(form_class())
+        render = (time.perf_counter() - start) / (n // 10 or 1)
+        results[observation_type] = {'construct_ms': construct * 1000, 'render_ms': render * 1000}
+    return results
+
+
+def bench_client_construction(agent, n=20):
+    from suds.cache import NoCache
+    from suds.client import Client
+    from tom_lt.lt import LTClientPool
+
+    start = time.perf_counter()
+    for _ in range(n):
+        Client(url=agent.url + '?wsdl', cache=NoCache())
+    fresh = (time.perf_counter() - start) / n
+
+    pool = LTClientPool()
+    with pool.checkout():
+        pass
+    start = time.perf_counter()
+    for _ in range(n):
+        with pool.checkout():
+            pass
+    pooled = (time.perf_counter() - start) / n
+    pool.clear()
+    return {'fresh_ms': fresh * 1000, 'pooled_ms': pooled * 1000}
+
+
+def build_ioo_schedule_elementwise(filter, binning, exp_count, exp_time):
+    """
+    The IO:O Schedule built one element at a time, as the forms did before ScheduleTemplate.
+    """
+    from lxml import etree
+
+    schedule = etree.Element('Schedule')
+    device = etree.SubElement(schedule, 'Device', name="IO:O", type="camera")
+    etree.SubElement(device, 'SpectralRegion').text = 'optical'
+    setup = etree.SubElement(device, 'Setup')
+    etree.SubElement(setup, 'Filter', type=filter)
+    detector = etree.SubElement(setup, 'Detector')
+    binning_element = etree.SubElement(detector, 'Binning')
+    etree.SubElement(binning_element, 'X', units='pixels').text = binning.split('x')[0]
+    etree.SubElement(binning_element, 'Y', units='pixels').text = binning.split('x')[1]
+    exposure = etree.SubElement(schedule, 'Exposure', count=str(exp_count))
+    etree.SubElement(exposure, 'Value', units='seconds').text = str(exp_time)
+    return schedule
+
+
+def bench_schedule_templates(n=20000):
+    from tom_lt.lt import IOO_FILTERS, IOO_SCHEDULE
+
+    filters = [filter for filter, _, _ in IOO_FILTERS]
+    elements = sum(1 for _ in IOO_SCHEDULE.skeleton.iter())
+    start = time.perf_counter()
+    for i in range(n):
+        build_ioo_schedule_elementwise(filters[i % len(filters)], '2x2', 1, 30.0)
+    elementwise = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(n):
+        IOO_SCHEDULE.render(filter=filters[i % len(filters)], binning_x='2', binning_y='2',
+                            exp_count=1, exp_time=30.0)
+    template = time.perf_counter() - start
+    return {'elementwise': n * elements / elementwise, 'template': n * elements / template}
+
+
+def bench_cadence(facility, data, target, windows=500):
+    """
+    Time building the payload for a cadence of ``windows`` one-hour windows, three hours apart.
+    """
+    start = datetime.combine(date.today() + timedelta(days=1), datetime.min.time())
+    end = start + timedelta(hours=3 * (windows - 1) + 1)
+    data = dict(data, startdate=start.date().isoformat(), starttime='00:00', cadence_interval=3, cadence_window=1,
+                enddate=end.date().isoformat(), endtime=end.strftime('%H:%M'))
+    begin = time.perf_counter()
+    payload = build_payload(facility, data, target)
+    return {'windows': len(payload.element.findall('Schedule')), 'ms': (time.perf_counter() - begin) * 1000}
+
+
+def bench_transports(n=200, concurrency=4):
+    """
+    Node agent calls per second through each transport, with ``concurrency`` calls in flight.
+    """
+    from tom_lt.lt import LT_SETTINGS, build_status_inquiry, client_pool
+    from tom_lt.lt_transport import AsyncSOAPTransport, SudsThreadTransport
+
+    documents = [str(build_status_inquiry(str(i))) for i in range(n)]
+    results = {}
+    for name, transport in (('suds', SudsThreadTransport(client_pool, max_concurrency=concurrency)),
+                            ('async', AsyncSOAPTransport(LT_SETTINGS, max_concurrency=concurrency))):
+        # Leave building the client or opening the connection out of the timing
+        transport.handle_rtml(documents[0])
+        start = time.perf_counter()
+        futures = [transport.submit(document) for document in documents]
+        errors = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                errors += 1
+        results[name] = {'per_second': n / (time.perf_counter() - start), 'errors': errors}
+        transport.close()
+    return results
+
+
+def bench_submissions(facility, data, target, n=200, concurrency=4):
+    def submit(_):
+        start = time.perf_counter()
+        try:
+            facility.submit_observation(build_payload(facility, data, target))
+        except Exception:
+            return time.perf_counter() - start, False
+        return time.perf_counter() - start, True
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(submit, range(n)))
+    wall = time.perf_counter() - start
+    latencies = [latency for latency, ok in results]
+    return {
+        'per_second': n / wall,
+        'errors': sum(1 for latency, ok in results if not ok),
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+    }
+
+
+def run(requests=200, concurrency=4, latency=0.0, failure_rate=0.0):
+    from tom_targets.models import Target
+    from tom_lt.lt import LT_SETTINGS, LTFacility
+    from tom_lt.lt_node_agent import NodeAgentStandIn
+
+    # One structured record per timing would swamp the benchmark output
+    logging.getLogger('tom_lt.metrics').setLevel(logging.WARNING)
+    agent = NodeAgentStandIn(latency=latency, failure_rate=failure_rate).start()
+    original = dict(LT_SETTINGS)
+    LT_SETTINGS.update(LT_HOST=agent.host, LT_PORT=agent.port, DEBUG=False, QUEUED=False)
+    # An unsaved target is enough, since the forms are handed it rather than querying for it
+    target = Target(pk=0, name='lt-bench', type='SIDEREAL', ra=83.8221, dec=-5.3911, epoch=2000)
+    project = LT_SETTINGS['proposalIDs'][0][0]
+    try:
+        for module in ('tom_lt.lt_stub', 'tom_lt.lt'):
+            startup = bench_startup(module)
+            print('import {0}: {import_ms:.1f} ms, {rss_kb} kB peak RSS, heavy modules loaded: {1}'.format(
+                module, ', '.join(startup['heavy']) or 'none', **startup))
+        construction = bench_client_construction(agent)
+        print('client construction: fresh {fresh_ms:.2f} ms, pooled {pooled_ms:.3f} ms'.format(**construction))
+        templates = bench_schedule_templates()
+        print('IO:O schedule generation: element by element {elementwise:,.0f} elements/s, '
+              'template {template:,.0f} elements/s'.format(**templates))
+        for name, result in bench_transports(requests, concurrency).items():
+            print('{0:5} transport {per_second:8.1f} calls/s  {errors} errors'.format(name, **result))
+        facility = LTFacility()
+        for observation_type, result in bench_forms(facility).items():
+            print('{0:6} form construction {construct_ms:.3f} ms, render {render_ms:.2f} ms'.format(
+                observation_type, **result))
+        cadence = bench_cadence(facility, form_data('SPRAT', target, project), target)
+        print('SPRAT cadence of {windows} windows built in {ms:.1f} ms'.format(**cadence))
+        for observation_type in INSTRUMENT_DATA:
+            data = form_data(observation_type, target, project)
+            result = bench_submissions(facility, data, target, n=requests, concurrency=concurrency)
+            print('{0:6} {per_second:8.1f} submissions/s  p50 {p50_ms:7.2f} ms  p99 {p99_ms:7.2f} ms  '
+                  '{errors} errors'.format(observation_type, **result))
+    finally:
+        LT_SETTINGS.clear()
+        LT_SETTINGS.update(original)
+        agent.stop()
+
+
+if __name__ == '__main__':
+    import django
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each node agent call')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tom_lt.settings')
+    django.setup()
+    run(args.requests, args.concurrency, args.latency, args.failure_rate)
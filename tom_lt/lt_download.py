@@ -0,0 +1,92 @@
+"""
+Streaming, resumable downloads of Liverpool Telescope data products.
+
+Files are written in fixed-size chunks to a ``.part`` file next to their destination, so nothing
+is held in memory and an interrupted download resumes from where it stopped (using an HTTP Range
+request) the next time it is attempted. The file is only moved into place once its length, and
+its MD5 checksum when one is known, have been verified.
+"""
+import base64
+import hashlib
+import logging
+import os
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def _hash_file(path, chunk_size):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5
+
+
+def download(url, path, checksum=None, chunk_size=DEFAULT_CHUNK_SIZE, timeout=60):
+    """
+    Stream ``url`` to ``path``, resuming a previous partial download if there is one.
+
+    ``checksum`` is the expected hex MD5 of the whole file; if it is not given, a ``Content-MD5``
+    header sent by the server is used instead. Returns ``path``.
+    """
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    partial = path + '.part'
+    offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+
+    request = urllib.request.Request(url)
+    if offset:
+        request.add_header('Range', 'bytes={0}-'.format(offset))
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        if offset and response.status != 206:
+            # The server ignored the Range header and is sending the whole file again
+            offset = 0
+        md5 = _hash_file(partial, chunk_size) if offset else hashlib.md5()
+        length = response.headers.get('Content-Length')
+        header_md5 = response.headers.get('Content-MD5')
+        with open(partial, 'ab' if offset else 'wb') as f:
+            for chunk in iter(lambda: response.read(chunk_size), b''):
+                f.write(chunk)
+                md5.update(chunk)
+
+    size = os.path.getsize(partial)
+    if length is not None and size != offset + int(length):
+        # Keep the partial file so that the next attempt can resume it
+        raise IOError('Incomplete download of {0}: {1} bytes received'.format(url, size))
+    if checksum is None and header_md5:
+        checksum = base64.b64decode(header_md5).hex()
+    if checksum is not None and md5.hexdigest() != checksum.lower():
+        os.remove(partial)
+        raise ChecksumError('Checksum mismatch for {0}'.format(url))
+    os.replace(partial, path)
+    logger.info('Downloaded %s to %s', url, path)
+    return path
+
+
+def download_all(files, max_workers=4, chunk_size=DEFAULT_CHUNK_SIZE, timeout=60):
+    """
+    Download many files at once with at most ``max_workers`` transfers in flight.
+
+    ``files`` is an iterable of dicts with ``url`` and ``path`` (and optionally ``checksum``) keys.
+    Returns a list of ``(file, error)`` tuples, in order, where ``error`` is None on success.
+    """
+    def fetch(file):
+        try:
+            download(file['url'], file['path'], checksum=file.get('checksum'),
+                     chunk_size=chunk_size, timeout=timeout)
+        except Exception as e:
+            logger.warning('Failed to download %s: %s', file['url'], e)
+            return file, e
+        return file, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(fetch, files))
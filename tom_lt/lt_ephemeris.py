@@ -0,0 +1,205 @@
+"""
+Ephemerides of non-sidereal targets for Liverpool Telescope requests.
+
+Positions are propagated from the orbital elements of a TOM Target (as stored by the
+MPC_MINOR_PLANET and MPC_COMET schemes) with NumPy, for every requested time in one pass: Kepler's
+equation is solved for all times at once, and the Earth's position comes from a single vectorised
+call to erfa.epv00. Long observing windows are split into sub-windows over which the target moves
+no more than a given angle, each with the target's coordinates at its midpoint:
+
+    windows, ra, dec = split_window(target, '2030-01-01T12:00', '2030-01-03T12:00', max_motion=60)
+
+Positions are astrometric (J2000) and geocentric, corrected for light time. Topocentric parallax
+is ignored, which matters only for objects very close to the Earth.
+"""
+import numpy as np
+
+# Gaussian gravitational constant (radians per day) and the speed of light (AU per day)
+GAUSSIAN_K = 0.01720209895
+SPEED_OF_LIGHT = 173.1446326846693
+# Obliquity of the ecliptic at J2000, in degrees
+OBLIQUITY_J2000 = 23.4392911
+# TT - UTC in seconds, close enough for the difference between TT and TDB not to matter
+TT_MINUS_UTC = 69.184
+
+
+def modified_julian_date(times):
+    """
+    Convert numpy datetime64 values (or ISO 8601 strings) to MJD.
+    """
+    times = np.asarray(times, dtype='datetime64[ms]')
+    return (times - np.datetime64('1858-11-17T00:00:00')).astype(np.float64) / 86400000.0
+
+
+def _solve_elliptic(mean_anomaly, e, iterations=30):
+    eccentric = mean_anomaly + e * np.sin(mean_anomaly)
+    for _ in range(iterations):
+        step = (eccentric - e * np.sin(eccentric) - mean_anomaly) / (1 - e * np.cos(eccentric))
+        eccentric -= step
+        if np.all(np.abs(step) < 1e-12):
+            break
+    return eccentric
+
+
+def _solve_hyperbolic(mean_anomaly, e, iterations=50):
+    anomaly = np.arcsinh(mean_anomaly / e)
+    for _ in range(iterations):
+        step = (e * np.sinh(anomaly) - anomaly - mean_anomaly) / (e * np.cosh(anomaly) - 1)
+        anomaly -= step
+        if np.all(np.abs(step) < 1e-12):
+            break
+    return anomaly
+
+
+def orbital_position(target, mjd):
+    """
+    Heliocentric equatorial (J2000) positions in AU, shape (len(mjd), 3), of ``target`` at the
+    TT modified Julian dates ``mjd``.
+    """
+    e = float(target.eccentricity)
+    if target.scheme == 'MPC_COMET' or target.mean_anomaly is None:
+        q = float(target.perihdist)
+        since_perihelion = mjd - float(target.epoch_of_perihelion)
+        a = q / abs(1 - e) if e != 1 else None
+        mean_anomaly = GAUSSIAN_K / a ** 1.5 * since_perihelion if a else None
+    else:
+        a = float(target.semimajor_axis)
+        motion = target.mean_daily_motion
+        motion = np.radians(float(motion)) if motion else GAUSSIAN_K / a ** 1.5
+        mean_anomaly = np.radians(float(target.mean_anomaly)) + motion * (mjd - float(target.epoch_of_elements))
+        q = a * (1 - e)
+
+    if e < 1:
+        eccentric = _solve_elliptic(np.remainder(mean_anomaly, 2 * np.pi), e)
+        x = a * (np.cos(eccentric) - e)
+        y = a * np.sqrt(1 - e * e) * np.sin(eccentric)
+    elif e > 1:
+        anomaly = _solve_hyperbolic(mean_anomaly, e)
+        x = a * (e - np.cosh(anomaly))
+        y = a * np.sqrt(e * e - 1) * np.sinh(anomaly)
+    else:
+        # Barker's equation for a parabolic orbit, solved in closed form
+        w = 3 * GAUSSIAN_K * since_perihelion / (np.sqrt(2) * q ** 1.5)
+        root = np.cbrt(w / 2 + np.sqrt(w * w / 4 + 1))
+        s = root - 1 / root
+        x = q * (1 - s * s)
+        y = 2 * q * s
+
+    node, perihelion, inclination = (np.radians(float(value)) for value in
+                                     (target.lng_asc_node, target.arg_of_perihelion, target.inclination))
+    cos_node, sin_node = np.cos(node), np.sin(node)
+    cos_peri, sin_peri = np.cos(perihelion), np.sin(perihelion)
+    cos_inc, sin_inc = np.cos(inclination), np.sin(inclination)
+    p = np.array([cos_peri * cos_node - sin_peri * sin_node * cos_inc,
+                  cos_peri * sin_node + sin_peri * cos_node * cos_inc,
+                  sin_peri * sin_inc])
+    q_vector = np.array([-sin_peri * cos_node - cos_peri * sin_node * cos_inc,
+                         -sin_peri * sin_node + cos_peri * cos_node * cos_inc,
+                         cos_peri * sin_inc])
+    ecliptic = np.outer(x, p) + np.outer(y, q_vector)
+
+    obliquity = np.radians(OBLIQUITY_J2000)
+    return np.column_stack([
+        ecliptic[:, 0],
+        ecliptic[:, 1] * np.cos(obliquity) - ecliptic[:, 2] * np.sin(obliquity),
+        ecliptic[:, 1] * np.sin(obliquity) + ecliptic[:, 2] * np.cos(obliquity),
+    ])
+
+
+def ephemeris(target, times):
+    """
+    Return the geocentric right ascension and declination (degrees, J2000) of ``target`` at each
+    of ``times`` (datetime64 values or ISO 8601 strings, UTC), computed in one batched pass.
+    """
+    import erfa
+
+    mjd = np.atleast_1d(modified_julian_date(times)) + TT_MINUS_UTC / 86400.0
+    earth = erfa.epv00(2400000.5, mjd)[0]['p']
+    geocentric = orbital_position(target, mjd) - earth
+    # Correct for light time, where the target was when the light left it
+    light_time = np.linalg.norm(geocentric, axis=1) / SPEED_OF_LIGHT
+    geocentric = orbital_position(target, mjd - light_time) - earth
+    distance = np.linalg.norm(geocentric, axis=1)
+    ra = np.degrees(np.arctan2(geocentric[:, 1], geocentric[:, 0])) % 360.0
+    dec = np.degrees(np.arcsin(geocentric[:, 2] / distance))
+    return ra, dec
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """
+    Angular separation in degrees between positions in degrees, by the haversine formula.
+    """
+    ra1, dec1, ra2, dec2 = (np.radians(value) for value in (ra1, dec1, ra2, dec2))
+    haversine = (np.sin((dec2 - dec1) / 2) ** 2 +
+                 np.cos(dec1) * np.cos(dec2) * np.sin((ra2 - ra1) / 2) ** 2)
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(haversine, 0, 1))))
+
+
+def window_middle(start, end):
+    """
+    The datetime64 halfway between ``start`` and ``end``.
+    """
+    start, end = np.datetime64(start, 's'), np.datetime64(end, 's')
+    return start + (end - start) // 2
+
+
+def coordinates(targets, when):
+    """
+    Right ascensions and declinations (degrees) of a mix of sidereal and non-sidereal targets, the
+    latter at the time ``when``.
+    """
+    ra = np.array([np.nan if target.ra is None else target.ra for target in targets], dtype=np.float64)
+    dec = np.array([np.nan if target.dec is None else target.dec for target in targets], dtype=np.float64)
+    for i, target in enumerate(targets):
+        if target.type == 'NON_SIDEREAL':
+            (ra[i],), (dec[i],) = ephemeris(target, [when])
+    return ra, dec
+
+
+def split_window(target, start, end, max_motion=60, step=10, max_windows=None):
+    """
+    Split the window from ``start`` to ``end`` into sub-windows during which ``target`` moves at
+    most ``max_motion`` arcseconds, with the ephemeris evaluated every ``step`` minutes. When that
+    would give more than ``max_windows`` sub-windows, the allowed motion is raised to fit.
+
+    Returns a list of (start, end) datetime64 pairs, and the right ascensions and declinations
+    (degrees) of the target at the middle of each sub-window.
+    """
+    start, end = np.datetime64(start, 's'), np.datetime64(end, 's')
+    times = np.arange(start, end, np.timedelta64(int(step * 60), 's'))
+    times = np.append(times, end)
+    ra, dec = ephemeris(target, times)
+    path = np.concatenate([[0.0], np.cumsum(angular_separation(ra[:-1], dec[:-1], ra[1:], dec[1:]))])
+    if max_windows:
+        max_motion = max(max_motion, path[-1] * 3600 / max_windows * 1.001)
+    # A new sub-window begins every time the distance travelled passes a multiple of max_motion
+    leg = np.floor(path * 3600 / max_motion)
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(leg)) + 1, [len(times) - 1]])
+    bounds = np.unique(bounds)
+    if len(bounds) == 1:
+        bounds = np.array([0, len(times) - 1])
+    middles = (bounds[:-1] + bounds[1:]) // 2
+    windows = list(zip(times[bounds[:-1]], times[bounds[1:]]))
+    return windows, ra[middles], dec[middles]
+
+
+def sexagesimal(ra, dec, ra_places=3, dec_places=2):
+    """
+    Convert arrays of right ascension and declination in degrees to (hours, minutes, seconds) and
+    (sign, degrees, arcminutes, arcseconds) arrays. The seconds are rounded to ``ra_places`` and
+    the arcseconds to ``dec_places`` decimal places before splitting, so neither ever reaches 60.
+    """
+    ra_unit = 10 ** ra_places
+    # Whole units of the last RA decimal place, wrapped so that 24h comes out as 0h
+    ra_units = np.round(np.asarray(ra, dtype=np.float64) / 15.0 * 3600 * ra_unit) % (24 * 3600 * ra_unit)
+    h, remainder = np.divmod(ra_units, 3600 * ra_unit)
+    m, remainder = np.divmod(remainder, 60 * ra_unit)
+    s = remainder / ra_unit
+    dec = np.asarray(dec, dtype=np.float64)
+    sign = np.where(dec < 0, '-', '+')
+    dec_unit = 10 ** dec_places
+    dec_units = np.round(np.abs(dec) * 3600 * dec_unit)
+    d, remainder = np.divmod(dec_units, 3600 * dec_unit)
+    am, remainder = np.divmod(remainder, 60 * dec_unit)
+    asec = remainder / dec_unit
+    return (h, m, s), (sign, d, am, asec)
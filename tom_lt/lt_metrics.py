@@ -0,0 +1,127 @@
+"""
+Timings and counters for the hot paths of the Liverpool Telescope facility.
+
+Each measurement is logged as a structured record on the ``tom_lt.metrics`` logger (the
+``metric``, ``duration_ms`` and any extra fields are attached to the record, and
+StructuredFormatter renders them as JSON), accumulated in-process for a Prometheus text export,
+and optionally sent to a StatsD daemon over UDP.
+"""
+import hmac
+import json
+import logging
+import socket
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+
+logger = logging.getLogger('tom_lt.metrics')
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    Format log records as one JSON object per line, including the metric fields.
+    """
+    FIELDS = ('metric', 'duration_ms', 'value', 'fields')
+
+    def format(self, record):
+        data = {'time': self.formatTime(record), 'logger': record.name, 'level': record.levelname,
+                'message': record.getMessage()}
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                data[field] = getattr(record, field)
+        return json.dumps(data, default=str)
+
+
+class Metrics:
+    def __init__(self, prefix='tom_lt'):
+        self.prefix = prefix
+        self.counters = {}
+        self.timings = {}
+        self.gauges = {}
+        self._lock = threading.Lock()
+        self._statsd = None
+
+    def configure_statsd(self, host, port=8125):
+        if host:
+            self._statsd = ((host, int(port)), socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+
+    def _send_statsd(self, line):
+        if self._statsd is not None:
+            address, sock = self._statsd
+            try:
+                sock.sendto('{0}.{1}'.format(self.prefix, line).encode('utf-8'), address)
+            except OSError:
+                pass
+
+    def increment(self, name, value=1, **fields):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        logger.debug('%s +%s', name, value, extra={'metric': name, 'value': value, 'fields': fields})
+        self._send_statsd('{0}:{1}|c'.format(name, value))
+
+    def observe(self, name, seconds, **fields):
+        with self._lock:
+            count, total, maximum = self.timings.get(name, (0, 0.0, 0.0))
+            self.timings[name] = (count + 1, total + seconds, max(maximum, seconds))
+        duration_ms = seconds * 1000
+        logger.info('%s took %.2f ms', name, duration_ms,
+                    extra={'metric': name, 'duration_ms': round(duration_ms, 3), 'fields': fields})
+        self._send_statsd('{0}:{1:.3f}|ms'.format(name, duration_ms))
+
+    @contextmanager
+    def timed(self, name, **fields):
+        """
+        Time the enclosed block as ``name``, counting ``<name>_errors`` if it raises.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.increment(name + '_errors', **fields)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **fields)
+
+    def register_gauge(self, name, func):
+        """
+        Export the value returned by ``func`` as a gauge whenever the metrics are read.
+        """
+        self.gauges[name] = func
+
+    def prometheus_text(self):
+        lines = []
+        with self._lock:
+            counters = dict(self.counters)
+            timings = dict(self.timings)
+        for name, value in sorted(counters.items()):
+            metric = '{0}_{1}_total'.format(self.prefix, name)
+            lines += ['# TYPE {0} counter'.format(metric), '{0} {1}'.format(metric, value)]
+        for name, (count, total, maximum) in sorted(timings.items()):
+            metric = '{0}_{1}_seconds'.format(self.prefix, name)
+            lines += ['# TYPE {0} summary'.format(metric),
+                      '{0}_count {1}'.format(metric, count),
+                      '{0}_sum {1:.6f}'.format(metric, total),
+                      '# TYPE {0}_max gauge'.format(metric),
+                      '{0}_max {1:.6f}'.format(metric, maximum)]
+        for name, func in sorted(self.gauges.items()):
+            metric = '{0}_{1}'.format(self.prefix, name)
+            lines += ['# TYPE {0} gauge'.format(metric), '{0} {1}'.format(metric, func())]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def prometheus_view(request):
+    """
+    Serve the metrics in the Prometheus text format to staff users, and to scrapers that send the
+    LT facility's METRICS_TOKEN setting as a bearer token.
+    """
+    token = getattr(settings, 'FACILITIES', {}).get('LT', {}).get('METRICS_TOKEN')
+    authorization = request.headers.get('Authorization', '')
+    if not (request.user.is_staff or token and hmac.compare_digest(authorization, 'Bearer ' + token)):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.prometheus_text(), content_type='text/plain; version=0.0.4')
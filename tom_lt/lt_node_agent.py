@@ -0,0 +1,213 @@
+"""
+A local stand-in for the Liverpool Telescope node agent.
+
+It serves the ``node_agent2/node_agent?wsdl`` contract with a single ``handle_rtml`` operation and
+answers RTML documents the way the telescope does: requests are confirmed, inquiries get an offer,
+status inquiries report a configurable mode and abort requests are acknowledged. Responses can be
+forced to rejections, delayed, or made to fail at random, so that every network path of
+LTFacility can be exercised without the real telescope:
+
+    agent = NodeAgentStandIn(latency=0.05, failure_rate=0.1).start()
+    FACILITIES['LT'].update(LT_HOST=agent.host, LT_PORT=agent.port)
+    ...
+    agent.stop()
+
+It can also be run on its own with ``python -m tom_lt.lt_node_agent [port]``.
+"""
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lxml import etree
+
+NODE_AGENT_PATH = '/node_agent2/node_agent'
+NODE_AGENT_NS = 'urn:node_agent'
+SOAP_ENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+SOAP_ENC_NS = 'http://schemas.xmlsoap.org/soap/encoding/'
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+XSD_NS = 'http://www.w3.org/2001/XMLSchema'
+
+WSDL_TEMPLATE = '''<?xml version="1.0" encoding="UTF-8"?>
+<wsdl:definitions targetNamespace="{ns}" xmlns:impl="{ns}" xmlns:soapenc="{enc}"
+                  xmlns:wsdl="http://schemas.xmlsoap.org/wsdl/"
+                  xmlns:wsdlsoap="http://schemas.xmlsoap.org/wsdl/soap/"
+                  xmlns:xsd="http://www.w3.org/2001/XMLSchema">
+  <wsdl:message name="handle_rtmlRequest">
+    <wsdl:part name="document" type="xsd:string"/>
+  </wsdl:message>
+  <wsdl:message name="handle_rtmlResponse">
+    <wsdl:part name="handle_rtmlReturn" type="xsd:string"/>
+  </wsdl:message>
+  <wsdl:portType name="NodeAgent">
+    <wsdl:operation name="handle_rtml" parameterOrder="document">
+      <wsdl:input message="impl:handle_rtmlRequest" name="handle_rtmlRequest"/>
+      <wsdl:output message="impl:handle_rtmlResponse" name="handle_rtmlResponse"/>
+    </wsdl:operation>
+  </wsdl:portType>
+  <wsdl:binding name="node_agentSoapBinding" type="impl:NodeAgent">
+    <wsdlsoap:binding style="rpc" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <wsdl:operation name="handle_rtml">
+      <wsdlsoap:operation soapAction=""/>
+      <wsdl:input name="handle_rtmlRequest">
+        <wsdlsoap:body encodingStyle="{enc}" namespace="{ns}" use="encoded"/>
+      </wsdl:input>
+      <wsdl:output name="handle_rtmlResponse">
+        <wsdlsoap:body encodingStyle="{enc}" namespace="{ns}" use="encoded"/>
+      </wsdl:output>
+    </wsdl:operation>
+  </wsdl:binding>
+  <wsdl:service name="NodeAgentService">
+    <wsdl:port binding="impl:node_agentSoapBinding" name="node_agent">
+      <wsdlsoap:address location="{location}"/>
+    </wsdl:port>
+  </wsdl:service>
+</wsdl:definitions>
+'''
+
+
+class NodeAgentStandIn:
+    """
+    Configurable in-process node agent.
+
+    :param reject: answer every request and inquiry with a rejection
+    :param status_mode: RTML mode returned for status inquiries, e.g. 'confirmation' or 'complete'
+    :param image_urls: frame URLs listed in status responses once ``status_mode`` is 'complete'
+    :param latency: seconds to wait before answering each call
+    :param failure_rate: fraction of calls (0-1) that fail with a SOAP fault
+    """
+    def __init__(self, host='127.0.0.1', port=0, reject=False, status_mode='confirmation', image_urls=(),
+                 latency=0, failure_rate=0):
+        self.reject = reject
+        self.status_mode = status_mode
+        self.image_urls = list(image_urls)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self.wsdl_requests = 0
+        self.received = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def host(self):
+        return self._server.server_address[0]
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}{2}'.format(self.host, self.port, NODE_AGENT_PATH)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def wsdl(self):
+        return WSDL_TEMPLATE.format(ns=NODE_AGENT_NS, enc=SOAP_ENC_NS, location=self.url)
+
+    def respond(self, document):
+        """
+        Build the RTML response string for a request document.
+        """
+        request = etree.fromstring(document.encode('utf-8'))
+        mode = request.get('mode')
+        response = etree.Element('RTML', nsmap={None: request.nsmap.get(None, 'http://www.rtml.org/v3.1a')},
+                                 version='3.1a', uid=request.get('uid', ''))
+        if self.reject and mode in ('request', 'inquiry'):
+            response.set('mode', 'reject')
+            response.set('type', 'reject')
+        elif mode == 'request':
+            response.set('mode', 'confirmation')
+        elif mode == 'abort':
+            response.set('mode', 'abort')
+        elif mode == 'inquiry' and request.find('{*}Schedule') is not None:
+            response.set('mode', 'offer')
+        else:
+            response.set('mode', self.status_mode)
+            if self.status_mode == 'complete':
+                schedule = etree.SubElement(response, 'Schedule')
+                for url in self.image_urls:
+                    etree.SubElement(schedule, 'ImageData', type='FITS16', delivery='url').text = url
+        # The real node agent declares a Latin-1 encoding in its responses
+        return '<?xml version="1.0" encoding="ISO-8859-1"?>\n' + etree.tostring(response, encoding='unicode')
+
+    def _handler_class(self):
+        agent = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, which Nagle's algorithm would hold up on
+            # keep-alive connections
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body):
+                body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path.startswith(NODE_AGENT_PATH):
+                    with agent._lock:
+                        agent.wsdl_requests += 1
+                    self._send(200, agent.wsdl())
+                else:
+                    self._send(404, '')
+
+            def do_POST(self):
+                envelope = etree.fromstring(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                document = envelope.find('{%s}Body/*/*' % SOAP_ENV_NS).text
+                with agent._lock:
+                    agent.calls += 1
+                    agent.received.append(document)
+                if agent.latency:
+                    time.sleep(agent.latency)
+                if random.random() < agent.failure_rate:
+                    self._send(500, _envelope(fault='Injected node agent failure'))
+                else:
+                    self._send(200, _envelope(result=agent.respond(document)))
+
+        return Handler
+
+
+def _envelope(result=None, fault=None):
+    envelope = etree.Element('{%s}Envelope' % SOAP_ENV_NS,
+                             nsmap={'soapenv': SOAP_ENV_NS, 'xsi': XSI_NS, 'xsd': XSD_NS})
+    body = etree.SubElement(envelope, '{%s}Body' % SOAP_ENV_NS)
+    if fault is not None:
+        element = etree.SubElement(body, '{%s}Fault' % SOAP_ENV_NS)
+        etree.SubElement(element, 'faultcode').text = 'soapenv:Server'
+        etree.SubElement(element, 'faultstring').text = fault
+    else:
+        response = etree.SubElement(body, '{%s}handle_rtmlResponse' % NODE_AGENT_NS, nsmap={'ns1': NODE_AGENT_NS})
+        response.set('{%s}encodingStyle' % SOAP_ENV_NS, SOAP_ENC_NS)
+        value = etree.SubElement(response, 'handle_rtmlReturn')
+        value.set('{%s}type' % XSI_NS, 'xsd:string')
+        value.text = result
+    return etree.tostring(envelope, encoding='unicode')
+
+
+if __name__ == '__main__':
+    import sys
+
+    agent = NodeAgentStandIn(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8080).start()
+    print('Node agent stand-in listening on', agent.url)
+    try:
+        agent._thread.join()
+    except KeyboardInterrupt:
+        agent.stop()
@@ -0,0 +1,190 @@
+"""
+Database-backed submission queue for the Liverpool Telescope facility.
+
+When the LT facility is configured with ``'QUEUED': True`` submissions are stored here and a
+pending id is returned straight away, so web workers never wait on the node agent. A separate
+worker process drains the queue:
+
+    python -m tom_lt.lt_queue
+
+The queue is the LTSubmission model in the TOM's own database, so no broker is needed and the web
+and worker processes share it even when they run on separate machines (e.g. Heroku dynos). Every
+state change of the matching ObservationRecord goes through the ``observation_change_state`` hook.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+PENDING_PREFIX = 'pending-'
+
+QUEUED = 'QUEUED'
+SENDING = 'SENDING'
+SUBMITTED = 'SUBMITTED'
+FAILED = 'FAILED'
+CANCELED = 'CANCELED'
+
+
+def _setting(key, default):
+    # Read lazily so that the worker can configure Django before the settings are touched
+    return getattr(settings, 'FACILITIES', {}).get('LT', {}).get(key, default)
+
+
+def enqueue(observation_payload):
+    """
+    Store a payload for later submission and return its pending observation id.
+    """
+    from tom_lt.models import LTSubmission
+
+    return PENDING_PREFIX + str(LTSubmission.objects.create(payload=observation_payload).pk)
+
+
+def is_pending(observation_id):
+    return str(observation_id).startswith(PENDING_PREFIX)
+
+
+def cancel(pending_id):
+    """
+    Withdraw a submission that has not been sent yet. Returns False if it was already claimed by
+    a worker; once it has been submitted, LTFacility.cancel_observation aborts it at the telescope
+    under its submitted_id() instead.
+    """
+    from tom_lt.models import LTSubmission
+
+    submission_id = int(str(pending_id)[len(PENDING_PREFIX):])
+    return bool(LTSubmission.objects.filter(pk=submission_id, state=QUEUED).update(state=CANCELED))
+
+
+def submitted_id(pending_id):
+    """
+    Return the observation id the node agent gave a queued submission, or None if it has not
+    been submitted.
+    """
+    from tom_lt.models import LTSubmission
+
+    submission_id = int(str(pending_id)[len(PENDING_PREFIX):])
+    return LTSubmission.objects.filter(pk=submission_id, state=SUBMITTED).values_list(
+        'observation_id', flat=True).first()
+
+
+def states(pending_ids):
+    """
+    Return the (state, observation id) of each of the submissions ``pending_ids`` with a single
+    query, as a dict keyed by pending id. The observation id is None until the submission is sent.
+    """
+    from tom_lt.models import LTSubmission
+
+    pending_ids = {int(str(pending_id)[len(PENDING_PREFIX):]): str(pending_id) for pending_id in pending_ids}
+    if not pending_ids:
+        return {}
+    return {pending_ids[pk]: (state, observation_id) for pk, state, observation_id in
+            LTSubmission.objects.filter(pk__in=pending_ids).values_list('pk', 'state', 'observation_id')}
+
+
+def _release_stale_claims():
+    """
+    Put submissions claimed more than QUEUE_CLAIM_TIMEOUT seconds ago back in the queue; the worker
+    that claimed them died before recording the outcome. A submission that had reached the node
+    agent before the worker died is sent again.
+    """
+    from tom_lt.models import LTSubmission
+
+    stale = timezone.now() - timedelta(seconds=_setting('QUEUE_CLAIM_TIMEOUT', 600))
+    released = LTSubmission.objects.filter(state=SENDING, claimed_at__lt=stale).update(
+        state=QUEUED, attempts=F('attempts') + 1, claimed_at=None)
+    if released:
+        logger.warning('Returned %d stale LT submissions to the queue', released)
+
+
+def _claim():
+    """
+    Mark the next due submission as being sent and return it, or None if nothing is due. The
+    conditional UPDATE makes sure two workers never claim the same row.
+    """
+    from tom_lt.models import LTSubmission
+
+    _release_stale_claims()
+    while True:
+        now = timezone.now()
+        submission = LTSubmission.objects.filter(state=QUEUED, next_attempt__lte=now).order_by('pk').first()
+        if submission is None:
+            return None
+        if LTSubmission.objects.filter(pk=submission.pk, state=QUEUED).update(state=SENDING, claimed_at=now):
+            return submission
+
+
+def _change_state(pending_id, observation_id, status):
+    from tom_common.hooks import run_hook
+    from tom_observations.models import ObservationRecord
+
+    for record in ObservationRecord.objects.filter(facility='LT', observation_id=pending_id):
+        previous_status = record.status
+        record.observation_id = observation_id
+        record.status = status
+        record.save()
+        run_hook('observation_change_state', record, previous_status)
+
+
+def process_one(facility=None):
+    """
+    Send the next due submission to the node agent. Returns False when there was nothing to do.
+    """
+    from tom_lt.lt import LTFacility
+    from tom_lt.models import LTSubmission
+
+    facility = facility or LTFacility()
+    submission = _claim()
+    if submission is None:
+        return False
+    pending_id = PENDING_PREFIX + str(submission.pk)
+    submissions = LTSubmission.objects.filter(pk=submission.pk)
+    try:
+        response_rtml = facility._send_rtml(submission.payload)
+    except Exception as e:
+        attempts = submission.attempts + 1
+        if attempts >= _setting('QUEUE_MAX_ATTEMPTS', 5):
+            logger.error('Giving up on LT submission %s after %d attempts: %s', pending_id, attempts, e)
+            submissions.update(state=FAILED, attempts=attempts, error=str(e))
+            _change_state(pending_id, pending_id, FAILED)
+        else:
+            # Back off exponentially from QUEUE_RETRY_DELAY seconds
+            next_attempt = timezone.now() + timedelta(seconds=_setting('QUEUE_RETRY_DELAY', 30) * 2 ** (attempts - 1))
+            logger.warning('LT submission %s failed, retrying: %s', pending_id, e)
+            submissions.update(state=QUEUED, attempts=attempts, next_attempt=next_attempt, error=str(e),
+                               claimed_at=None)
+        return True
+
+    observation_id = response_rtml.get('uid')
+    if response_rtml.rejected:
+        submissions.update(state=FAILED, observation_id=observation_id, error='rejected')
+        _change_state(pending_id, observation_id, FAILED)
+    else:
+        submissions.update(state=SUBMITTED, observation_id=observation_id)
+        _change_state(pending_id, observation_id, 'PENDING')
+    return True
+
+
+def run_worker():
+    """
+    Drain the queue forever, sleeping for QUEUE_POLL_INTERVAL seconds whenever it is empty.
+    """
+    from tom_lt.lt import LTFacility
+
+    facility = LTFacility()
+    while True:
+        if not process_one(facility):
+            time.sleep(_setting('QUEUE_POLL_INTERVAL', 5))
+
+
+if __name__ == '__main__':
+    import os
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tom_lt.settings')
+    django.setup()
+    run_worker()
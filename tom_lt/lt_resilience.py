@@ -0,0 +1,102 @@
+"""
+Retry and circuit breaker helpers for calls to the Liverpool Telescope node agent.
+
+When the telescope site reboots every call would otherwise wait for the full socket timeout. The
+circuit breaker opens after a run of consecutive failures and fails calls immediately until its
+cooldown has passed, when a single trial call is let through to probe the node agent again.
+Idempotent calls (inquiries) are retried with jittered exponential backoff.
+"""
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling the node agent while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, cooldown=60):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def before_call(self):
+        """
+        Raise CircuitOpenError unless a call may be made now. In the half-open state only the
+        first caller is let through, as the trial call.
+        """
+        with self._lock:
+            state = self.state
+            if state == self.OPEN or (state == self.HALF_OPEN and self._trial_running):
+                remaining = max(0, self.cooldown - (time.monotonic() - self.opened_at))
+                raise CircuitOpenError('The Liverpool Telescope node agent is unavailable, '
+                                       'retrying in {0:.0f}s'.format(remaining))
+            if state == self.HALF_OPEN:
+                self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning('Opening the LT node agent circuit breaker after %d failures', self.failures)
+                self.opened_at = time.monotonic()
+
+    def call(self, func, *args, **kwargs):
+        self.before_call()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def stats(self):
+        return {'state': self.state, 'failures': self.failures}
+
+
+def retry(func, attempts=3, base_delay=0.5, max_delay=5.0):
+    """
+    Call ``func`` up to ``attempts`` times, sleeping for a random ("full jitter") fraction of an
+    exponentially growing delay between attempts. An open circuit is never retried.
+    """
+    for attempt in range(attempts):
+        try:
+            return func()
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            if attempt == attempts - 1:
+                raise
+            delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            logger.info('LT node agent call failed (%s), retrying in %.2fs', e, delay)
+            time.sleep(delay)
@@ -0,0 +1,187 @@
+"""
+Transports carrying ``handle_rtml`` calls to the Liverpool Telescope node agent.
+
+Both transports return a concurrent.futures.Future from ``submit()``, so several node agent calls
+can be in flight at once and any of them cancelled, and both bound the number of concurrent calls
+and give every call its own timeout:
+
+``SudsThreadTransport``
+    Runs suds clients checked out of an LTClientPool on a thread pool.
+``AsyncSOAPTransport``
+    Builds the rpc/encoded SOAP envelope itself and sends it from an asyncio event loop, running
+    in a background thread, over pooled keep-alive HTTP connections. No WSDL is fetched.
+
+The transport is chosen with the ``TRANSPORT`` LT setting ('suds' or 'async').
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+SOAP_ENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+SOAP_ENC_NS = 'http://schemas.xmlsoap.org/soap/encoding/'
+
+ENVELOPE_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<SOAP-ENV:Envelope xmlns:ns0="{namespace}" xmlns:SOAP-ENV="' + SOAP_ENV_NS + '" '
+    'xmlns:SOAP-ENC="' + SOAP_ENC_NS + '" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    'xmlns:xsd="http://www.w3.org/2001/XMLSchema" SOAP-ENV:encodingStyle="' + SOAP_ENC_NS + '">'
+    '<SOAP-ENV:Header/><SOAP-ENV:Body><ns0:handle_rtml>'
+    '<document xsi:type="xsd:string">{document}</document>'
+    '</ns0:handle_rtml></SOAP-ENV:Body></SOAP-ENV:Envelope>'
+)
+
+
+class TransportError(Exception):
+    """
+    Raised when the node agent answers with a SOAP fault or an HTTP error.
+    """
+
+
+class SudsThreadTransport:
+    def __init__(self, pool, max_concurrency=4, timeout=60):
+        self.pool = pool
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='lt-transport')
+
+    def _call(self, document, timeout):
+        with self.pool.checkout() as client:
+            client.set_options(timeout=timeout)
+            return client.service.handle_rtml(document)
+
+    def submit(self, document, timeout=None):
+        return self._executor.submit(self._call, document, timeout or self.timeout)
+
+    def handle_rtml(self, document, timeout=None):
+        return self.submit(document, timeout).result()
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class AsyncSOAPTransport:
+    """
+    :param lt_settings: the LT settings, read on every call for the host, port and credentials
+    :param namespace: namespace of the handle_rtml operation, as declared by the node agent WSDL
+    """
+    PATH = '/node_agent2/node_agent'
+
+    def __init__(self, lt_settings, max_concurrency=4, timeout=60, namespace='urn:node_agent'):
+        self.lt_settings = lt_settings
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.namespace = namespace
+        self._loop = None
+        self._semaphore = None
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self):
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name='lt-transport', daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def submit(self, document, timeout=None):
+        return asyncio.run_coroutine_threadsafe(self.call(document, timeout or self.timeout), self._ensure_loop())
+
+    def handle_rtml(self, document, timeout=None):
+        return self.submit(document, timeout).result()
+
+    async def call(self, document, timeout=None):
+        """
+        Send ``document`` to the node agent and return the RTML string it answers with.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await asyncio.wait_for(self._exchange(document), timeout or self.timeout)
+
+    def _request(self, host, port, document):
+        body = ENVELOPE_TEMPLATE.format(namespace=self.namespace, document=escape(document)).encode('utf-8')
+        headers = [
+            'POST {0} HTTP/1.1'.format(self.PATH),
+            'Host: {0}:{1}'.format(host, port),
+            'Content-Type: text/xml; charset=utf-8',
+            'SOAPAction: ""',
+            'Content-Length: {0}'.format(len(body)),
+            'Connection: keep-alive',
+            # The node agent takes its credentials as HTTP headers, as suds sends them
+            'Username: {0}'.format(self.lt_settings['username']),
+            'Password: {0}'.format(self.lt_settings['password']),
+        ]
+        return ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body
+
+    async def _exchange(self, document):
+        host, port = self.lt_settings['LT_HOST'], int(self.lt_settings['LT_PORT'])
+        request = self._request(host, port, document)
+        idle = self._idle.setdefault((host, port), [])
+        while True:
+            reused = bool(idle)
+            reader, writer = idle.pop() if reused else await asyncio.open_connection(host, port)
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, headers, body = await self._read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    # The node agent closed an idle keep-alive connection; try a fresh one
+                    continue
+                raise
+            except BaseException:
+                # Includes cancellation and timeouts, which leave the connection mid-response
+                writer.close()
+                raise
+            if headers.get('connection', '').lower() == 'close':
+                writer.close()
+            else:
+                idle.append((reader, writer))
+            return self._parse(status, body)
+
+    @staticmethod
+    async def _read_response(reader):
+        status_line = await reader.readuntil(b'\r\n')
+        status = int(status_line.split()[1])
+        headers = {}
+        while True:
+            line = await reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                chunk = await reader.readexactly(size + 2)
+                if size == 0:
+                    break
+                chunks.append(chunk[:-2])
+            body = b''.join(chunks)
+        else:
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+        return status, headers, body
+
+    @staticmethod
+    def _parse(status, body):
+        from lxml import etree
+
+        try:
+            envelope = etree.fromstring(body)
+        except etree.XMLSyntaxError:
+            raise TransportError('HTTP {0} from the node agent'.format(status))
+        fault = envelope.find('{%s}Body/{%s}Fault' % (SOAP_ENV_NS, SOAP_ENV_NS))
+        if fault is not None:
+            raise TransportError(fault.findtext('faultstring') or 'SOAP fault from the node agent')
+        if status != 200:
+            raise TransportError('HTTP {0} from the node agent'.format(status))
+        result = envelope.find('{%s}Body/*/*' % SOAP_ENV_NS)
+        return result.text if result is not None else None
+
+    def close(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
@@ -0,0 +1,149 @@
+"""
+Local feasibility check for Liverpool Telescope observing windows.
+
+Target altitude (and so airmass) and sun altitude are computed on a NumPy time grid spanning the
+window, for any number of targets at once, so a window in which a target never gets below the
+maximum airmass during the night can be caught before a request is sent to the node agent:
+
+    result = visibility(ra, dec, '2030-01-01T12:00', '2030-01-03T12:00', max_airmass=2,
+                        site=LTFacility.SITES['La Palma'])
+    result['observable']  # one boolean per target
+
+Low precision formulae are used for the sidereal time and the sun's position, and the target
+coordinates are not precessed, which is good to a few tenths of a degree; ample for deciding
+whether a window is worth submitting.
+"""
+import numpy as np
+
+J2000 = 2451545.0
+
+# Largest number of (target, time) samples evaluated at once, to bound memory in large batches
+MAX_BLOCK = 2 ** 20
+
+
+def julian_date(times):
+    """
+    Convert numpy datetime64 values (or ISO 8601 strings) to Julian dates.
+    """
+    times = np.asarray(times, dtype='datetime64[s]')
+    return (times - np.datetime64('1970-01-01T00:00:00')).astype(np.float64) / 86400.0 + 2440587.5
+
+
+def time_grid(start, end, step=10):
+    """
+    Return the datetime64 samples from ``start`` to ``end`` inclusive, ``step`` minutes apart.
+    """
+    start, end = np.datetime64(start, 's'), np.datetime64(end, 's')
+    grid = np.arange(start, end, np.timedelta64(int(step * 60), 's'))
+    return np.append(grid, end) if end > start else grid
+
+
+def local_sidereal_time(jd, longitude):
+    """
+    Local mean sidereal time in degrees for east-positive ``longitude`` in degrees.
+    """
+    return (280.46061837 + 360.98564736629 * (jd - J2000) + longitude) % 360.0
+
+
+def sun_position(jd):
+    """
+    Apparent right ascension and declination of the sun in degrees, good to about 0.01 degrees.
+    """
+    n = jd - J2000
+    mean_longitude = np.radians(280.460 + 0.9856474 * n)
+    anomaly = np.radians(357.528 + 0.9856003 * n)
+    ecliptic_longitude = mean_longitude + np.radians(1.915 * np.sin(anomaly) + 0.020 * np.sin(2 * anomaly))
+    obliquity = np.radians(23.439 - 0.0000004 * n)
+    ra = np.arctan2(np.cos(obliquity) * np.sin(ecliptic_longitude), np.cos(ecliptic_longitude))
+    dec = np.arcsin(np.sin(obliquity) * np.sin(ecliptic_longitude))
+    return np.degrees(ra) % 360.0, np.degrees(dec)
+
+
+def sin_altitude(ra, dec, lst, latitude):
+    """
+    Sine of the altitude of objects at ``ra``, ``dec`` for local sidereal times ``lst``, all in
+    degrees. The arguments broadcast against each other.
+    """
+    hour_angle = np.radians(lst - ra)
+    latitude, dec = np.radians(latitude), np.radians(dec)
+    return np.sin(latitude) * np.sin(dec) + np.cos(latitude) * np.cos(dec) * np.cos(hour_angle)
+
+
+def airmass(sin_alt):
+    """
+    Plane-parallel airmass, sec z, for the given sines of altitude; infinite below the horizon.
+    """
+    sin_alt = np.asarray(sin_alt, dtype=np.float64)
+    with np.errstate(divide='ignore'):
+        return np.where(sin_alt > 0, 1.0 / np.maximum(sin_alt, 1e-12), np.inf)
+
+
+def visibility(ra, dec, start, end, max_airmass, site, step=10, sun_altitude=-12):
+    """
+    Check which targets can be observed from ``site`` between ``start`` and ``end``.
+
+    ``ra`` and ``dec`` are scalars or equal-length sequences in degrees, and ``site`` is a dict
+    with ``latitude`` and ``longitude`` in degrees, as in LTFacility.SITES. A target is observable
+    at a grid sample when the sun is below ``sun_altitude`` degrees and the target's airmass is at
+    most ``max_airmass``. Returns a dict of arrays with one entry per target:
+
+    ``observable``
+        Whether the target is observable at any sample.
+    ``minutes``
+        Approximate observable time in the window, in minutes.
+    ``min_airmass``
+        The lowest airmass reached while the sun is down (infinite if it never rises, or if the
+        sun never sets in the window).
+    ``first``
+        The first observable sample, or NaT.
+
+    and ``night_minutes``, the time in the window during which the sun is down.
+    """
+    ra = np.atleast_1d(np.asarray(ra, dtype=np.float64))
+    dec = np.atleast_1d(np.asarray(dec, dtype=np.float64))
+    times = time_grid(start, end, step)
+    jd = julian_date(times)
+    lst = local_sidereal_time(jd, site['longitude'])
+
+    sun_ra, sun_dec = sun_position(jd)
+    dark = sin_altitude(sun_ra, sun_dec, lst, site['latitude']) < np.sin(np.radians(sun_altitude))
+    times, lst = times[dark], lst[dark]
+
+    best = np.full(ra.shape, -1.0)
+    counts = np.zeros(ra.shape, dtype=np.int64)
+    first = np.full(ra.shape, np.datetime64('NaT'), dtype='datetime64[s]')
+    if times.size:
+        threshold = 1.0 / max_airmass
+        block = max(1, MAX_BLOCK // times.size)
+        for i in range(0, ra.size, block):
+            sin_alt = sin_altitude(ra[i:i + block, None], dec[i:i + block, None], lst[None, :],
+                                   site['latitude'])
+            ok = sin_alt >= threshold
+            best[i:i + block] = sin_alt.max(axis=1)
+            counts[i:i + block] = ok.sum(axis=1)
+            any_ok = ok.any(axis=1)
+            first[i:i + block][any_ok] = times[ok.argmax(axis=1)[any_ok]]
+    return {
+        'observable': counts > 0,
+        'minutes': counts * step,
+        'min_airmass': airmass(best),
+        'first': first,
+        'night_minutes': times.size * step,
+    }
+
+
+def check_window(ra, dec, start, end, max_airmass, site, **kwargs):
+    """
+    Check a single target and window, returning a list of problems (empty if it is observable).
+    """
+    if np.datetime64(end, 's') <= np.datetime64(start, 's'):
+        return []
+    result = visibility(ra, dec, start, end, max_airmass, site, **kwargs)
+    if result['observable'][0]:
+        return []
+    if result['night_minutes'] == 0:
+        return ['The observing window does not include any night time at the telescope']
+    if np.isinf(result['min_airmass'][0]):
+        return ['The target does not rise above the horizon at night during the observing window']
+    return ['The target never gets below airmass {0} at night during the observing window '
+            '(best {1:.2f})'.format(max_airmass, result['min_airmass'][0])]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 03:01
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LTSubmission',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.TextField()),
+                ('state', models.CharField(db_index=True, default='QUEUED', max_length=16)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('observation_id', models.CharField(blank=True, max_length=64, null=True)),
+                ('error', models.TextField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import models
+from django.utils import timezone
+
+from tom_lt.lt_queue import QUEUED
+
+
+class LTSubmission(models.Model):
+    """
+    An observation request in the tom_lt.lt_queue submission queue.
+    """
+    payload = models.TextField()
+    state = models.CharField(max_length=16, default=QUEUED, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    # When a worker claimed the submission for sending, so that claims left by a dead worker expire
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    observation_id = models.CharField(max_length=64, null=True, blank=True)
+    error = models.TextField(null=True, blank=True)
+
+    def __str__(self):
+        return 'LT submission {0} ({1})'.format(self.pk, self.state)
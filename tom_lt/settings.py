@@ -54,7 +54,8 @@ INSTALLED_APPS = [
     'tom_catalogs',
     'tom_observations',
     'tom_dataproducts',
-    'tom_setup'
+    'tom_setup',
+    'tom_lt',
 ]
 
 SITE_ID = 1
@@ -160,15 +161,30 @@ MEDIA_URL = '/data/'
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {
+            '()': 'tom_lt.lt_metrics.StructuredFormatter',
+        }
+    },
     'handlers': {
         'console': {
             'class': 'logging.StreamHandler',
+        },
+        'lt_metrics': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'structured',
         }
     },
     'loggers': {
         '': {
             'handlers': ['console'],
             'level': 'INFO'
+        },
+        # Timings and counters from the LT facility, one JSON record per line
+        'tom_lt.metrics': {
+            'handlers': ['lt_metrics'],
+            'level': 'INFO',
+            'propagate': False
         }
     }
 }
@@ -259,7 +275,7 @@ AUTH_STRATEGY = 'READ_ONLY'
 OPEN_URLS = []
 
 HOOKS = {
-    'target_post_save': 'tom_common.hooks.target_post_save',
+    'target_post_save': 'tom_lt.hooks.target_post_save',
     'observation_change_state': 'tom_common.hooks.observation_change_state',
     'data_product_post_upload': 'tom_dataproducts.hooks.data_product_post_upload'
 }
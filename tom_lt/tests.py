@@ -0,0 +1,562 @@
+import base64
+import hashlib
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import numpy as np
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import caches
+from django.test import RequestFactory, SimpleTestCase, TestCase
+from django.utils import timezone
+
+from tom_observations.models import ObservationRecord
+from tom_targets.models import Target
+
+from tom_lt import lt_download, lt_ephemeris, lt_queue
+from tom_lt.lt import (IOO_FILTERS, LT_INQUIRY_RETRIES, LT_SETTINGS, LT_VALIDATION_CACHE, CoordinateCache,
+                       LTFacility, LTObservationForm, RTMLRejectError, RTMLResponse, build_target_elements,
+                       uid_generator)
+from tom_lt.lt_archive import RTMLArchive
+from tom_lt.lt_metrics import prometheus_view
+from tom_lt.lt_node_agent import NodeAgentStandIn
+from tom_lt.lt_resilience import CircuitBreaker, CircuitOpenError
+from tom_lt.models import LTSubmission
+
+
+class TestObservationPayload(TestCase):
+    @staticmethod
+    def form_data(target):
+        return {
+            'facility': 'LT', 'target_id': target.pk, 'project': LT_SETTINGS['proposalIDs'][0][0],
+            'startdate': '2030-01-01', 'starttime': '12:00', 'enddate': '2030-01-03', 'endtime': '12:00',
+            'max_airmass': 2, 'max_seeing': 1.2, 'max_skybri': 1, 'photometric': 'light',
+        }
+
+    def setUp(self):
+        self.target = Target.objects.create(name='southern', type=Target.SIDEREAL, ra=83.8221, dec=-0.5, epoch=2000)
+        self.data = self.form_data(self.target)
+
+    def _form(self, observation_type, **data):
+        form = LTFacility().get_form(observation_type)(dict(self.data, observation_type=observation_type, **data))
+        # Skip LTObservationForm.is_valid, which asks the node agent for an offer
+        self.assertTrue(super(LTObservationForm, form).is_valid(), form.errors)
+        return form
+
+    def test_ioo_payload_resolves_target_with_one_query(self):
+        data = {'binning': '2x2'}
+        for filter, _, _ in IOO_FILTERS:
+            data.update({'exp_time_' + filter: 30, 'exp_count_' + filter: 1})
+        form = self._form('IOO', **data)
+        with self.assertNumQueries(1):
+            payload = form.observation_payload()
+        self.assertEqual(len(payload.element.findall('{*}Schedule')), len(IOO_FILTERS))
+
+    def test_frodo_payload_resolves_target_with_one_query(self):
+        form = self._form('FRODO', exp_time_blue=120, exp_count_blue=1, res_blue='low',
+                          exp_time_red=120, exp_count_red=1, res_red='high')
+        with self.assertNumQueries(1):
+            payload = form.observation_payload()
+        self.assertEqual(len(payload.element.findall('{*}Schedule')), 2)
+
+    def test_cadence_batches_keep_each_window_together(self):
+        data = {'binning': '2x2', 'enddate': '2030-01-22', 'cadence_interval': 1, 'cadence_window': 0.5}
+        for filter, _, _ in IOO_FILTERS:
+            data.update({'exp_time_' + filter: 30, 'exp_count_' + filter: 1})
+        payload = self._form('IOO', **data).observation_payload()
+        documents = payload.batches(100)
+
+        windows = {}
+        for document in documents:
+            schedules = document.element.findall('{*}Schedule')
+            self.assertLessEqual(len(schedules), 100)
+            self.assertIsNotNone(document.element.find('{*}Project'))
+            for schedule in schedules:
+                start = schedule.find('{*}DateTimeConstraint/{*}DateTimeStart').get('value')
+                windows.setdefault(start, set()).add(document.element.get('uid'))
+        self.assertEqual(sum(len(document.element.findall('{*}Schedule')) for document in documents),
+                         len(payload.element.findall('{*}Schedule')))
+        self.assertTrue(all(len(uids) == 1 for uids in windows.values()))
+
+    def test_southern_declination_keeps_its_sign(self):
+        payload = self._form('IOI', exp_time=60, exp_count=5).observation_payload()
+        for schedule in payload.element.findall('{*}Schedule'):
+            degrees = schedule.findtext('{*}Target/{*}Coordinates/{*}Declination/{*}Degrees')
+            self.assertTrue(degrees.startswith('-'), degrees)
+
+
+class TestRejection(TestCase):
+    def test_a_reject_type_fails_every_submission_path(self):
+        target = Target.objects.create(name='rejected', type=Target.SIDEREAL, ra=10, dec=10, epoch=2000)
+        config = dict(TestObservationPayload.form_data(target), observation_type='IOI', exp_time=60, exp_count=5)
+        response = RTMLResponse(b'<RTML xmlns="http://www.rtml.org/v3.1a" mode="confirmation" type="reject" uid="1"/>')
+        facility = LTFacility()
+
+        with mock.patch('tom_lt.lt.call_node_agent_many', return_value=[response]):
+            result, = facility.submit_observations([target], config)
+        self.assertNotIn('observation_id', result)
+        self.assertTrue(result['errors'])
+
+        with mock.patch('tom_lt.lt.call_node_agent', return_value=response):
+            with self.assertRaises(RTMLRejectError):
+                facility.submit_observation('<RTML/>')
+
+
+class TestObservationStatus(TestCase):
+    @mock.patch.dict(LT_SETTINGS, DEBUG=True)
+    def test_integer_ids_are_looked_up_as_strings(self):
+        self.assertEqual(LTFacility().get_observation_status(0)['state'], 'PENDING')
+
+
+class TestVisibilityCheck(TestCase):
+    def setUp(self):
+        target = Target.objects.create(name='far south', type=Target.SIDEREAL, ra=10, dec=-80, epoch=2000)
+        self.data = dict(TestObservationPayload.form_data(target), observation_type='IOI', exp_time=60, exp_count=5)
+
+    @mock.patch.dict(LT_SETTINGS, DEBUG=True)
+    def test_warn_does_not_hold_the_request_back(self):
+        form = LTFacility().get_form('IOI')(self.data)
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertTrue(form.visibility_warnings)
+
+    @mock.patch.dict(LT_SETTINGS, DEBUG=True)
+    @mock.patch('tom_lt.lt.LT_VISIBILITY_CHECK', 'confirm')
+    def test_confirm_holds_the_request_back_until_ticked(self):
+        form = LTFacility().get_form('IOI')(self.data)
+        self.assertFalse(form.is_valid())
+        self.assertIn('ignore_visibility', form.errors)
+        form = LTFacility().get_form('IOI')(dict(self.data, ignore_visibility=True))
+        self.assertTrue(form.is_valid(), form.errors)
+
+    @mock.patch.dict(LT_SETTINGS, DEBUG=True)
+    @mock.patch('tom_lt.lt.LT_VISIBILITY_CHECK', 'block')
+    def test_block_rejects_the_request(self):
+        form = LTFacility().get_form('IOI')(dict(self.data, ignore_visibility=True))
+        self.assertFalse(form.is_valid())
+        self.assertTrue(form.non_field_errors())
+
+
+class TestEphemeris(TestCase):
+    def test_rounding_carries_into_minutes_and_degrees(self):
+        target, = build_target_elements('carry', [14.99999999], [-0.999999999], 'J2000')
+        self.assertEqual([target.findtext('Coordinates/RightAscension/' + part)
+                          for part in ('Hours', 'Minutes', 'Seconds')], ['1', '0', '0.000'])
+        self.assertEqual([target.findtext('Coordinates/Declination/' + part)
+                          for part in ('Degrees', 'Arcminutes', 'Arcseconds')], ['-1', '0', '0.00'])
+
+    def test_agrees_with_astropy_builtin_ephemeris(self):
+        import erfa
+        from astropy import units as u
+        from astropy.coordinates import SkyCoord, get_body_barycentric
+        from astropy.time import Time
+
+        # Osculating elements of Mars at the TT epoch, from the heliocentric state of the ERFA planetary theory
+        epoch = 61984.0
+        state = erfa.plan94(2400000.5, epoch, 4)
+        obliquity = np.radians(lt_ephemeris.OBLIQUITY_J2000)
+        to_ecliptic = np.array([[1, 0, 0],
+                                [0, np.cos(obliquity), np.sin(obliquity)],
+                                [0, -np.sin(obliquity), np.cos(obliquity)]])
+        r, v = to_ecliptic @ state['p'], to_ecliptic @ state['v']
+        mu = lt_ephemeris.GAUSSIAN_K ** 2
+        h = np.cross(r, v)
+        node = np.cross([0, 0, 1], h)
+        e_vector = np.cross(v, h) / mu - r / np.linalg.norm(r)
+        e = np.linalg.norm(e_vector)
+        true_anomaly = np.arctan2(np.cross(e_vector, r) @ h / np.linalg.norm(h), e_vector @ r)
+        eccentric = 2 * np.arctan(np.sqrt((1 - e) / (1 + e)) * np.tan(true_anomaly / 2))
+        mars = Target(name='mars', type=Target.NON_SIDEREAL, scheme='MPC_MINOR_PLANET', eccentricity=e,
+                      semimajor_axis=1 / (2 / np.linalg.norm(r) - v @ v / mu), epoch_of_elements=epoch,
+                      mean_anomaly=np.degrees(eccentric - e * np.sin(eccentric)),
+                      inclination=np.degrees(np.arccos(h[2] / np.linalg.norm(h))),
+                      lng_asc_node=np.degrees(np.arctan2(node[1], node[0])),
+                      arg_of_perihelion=np.degrees(np.arctan2(np.cross(node, e_vector) @ h / np.linalg.norm(h),
+                                                              node @ e_vector)))
+
+        times = np.datetime64('2028-08-01T00:00') + np.arange(0, 7 * 24 + 1, 6) * np.timedelta64(1, 'h')
+        ra, dec = lt_ephemeris.ephemeris(mars, times)
+
+        when = Time(lt_ephemeris.modified_julian_date(times), format='mjd', scale='utc')
+        earth = get_body_barycentric('earth', when, ephemeris='builtin')
+        light_time = 0
+        for _ in range(3):
+            geocentric = get_body_barycentric('mars', when - light_time * u.day, ephemeris='builtin') - earth
+            light_time = geocentric.norm().to_value(u.au) / lt_ephemeris.SPEED_OF_LIGHT
+        expected = SkyCoord(geocentric, frame='icrs').spherical
+        separation = lt_ephemeris.angular_separation(ra, dec, expected.lon.deg, expected.lat.deg) * 3600
+        self.assertLess(separation.max(), 1)
+
+
+class TestCoordinateCache(TestCase):
+    def test_edited_target_is_converted_again_and_invalidated(self):
+        target = Target.objects.create(name='moving', type=Target.SIDEREAL, ra=10, dec=10, epoch=2000)
+        cache = CoordinateCache()
+        self.assertEqual(cache.get(target)[3], '+10')
+
+        target.dec = -20
+        target.save()
+        self.assertEqual(cache.get(target)[3], '-20')
+        self.assertEqual(cache.misses, 2)
+
+        cache.invalidate(target)
+        self.assertEqual(cache.get(target)[3], '-20')
+        self.assertEqual(cache.misses, 3)
+
+
+class TestSubmissionQueue(TestCase):
+    def test_claims_are_exclusive_and_stale_claims_are_released(self):
+        pending_id = lt_queue.enqueue('<RTML/>')
+        submission = lt_queue._claim()
+        self.assertEqual(lt_queue.PENDING_PREFIX + str(submission.pk), pending_id)
+        self.assertIsNone(lt_queue._claim())
+        self.assertFalse(lt_queue.cancel(pending_id))
+
+        LTSubmission.objects.filter(pk=submission.pk).update(claimed_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(lt_queue._claim().pk, submission.pk)
+        self.assertEqual(LTSubmission.objects.get(pk=submission.pk).attempts, 1)
+
+    def test_pending_ids_follow_their_submission(self):
+        target = Target.objects.create(name='queued', type=Target.SIDEREAL, ra=10, dec=10, epoch=2000)
+        sent, failed = lt_queue.enqueue('<RTML/>'), lt_queue.enqueue('<RTML/>')
+        # The worker sent one before the view had created its ObservationRecord
+        LTSubmission.objects.filter(pk=lt_queue._claim().pk).update(state=lt_queue.SUBMITTED, observation_id='101')
+        LTSubmission.objects.filter(pk=lt_queue._claim().pk).update(state=lt_queue.FAILED)
+        for pending_id in (sent, failed):
+            ObservationRecord.objects.create(target=target, facility='LT', parameters={}, observation_id=pending_id,
+                                             status='PENDING')
+        caches[LT_VALIDATION_CACHE].set('tom_lt.status.101', {'state': 'IN_PROGRESS', 'scheduled_start': None,
+                                                              'scheduled_end': None})
+
+        facility = LTFacility()
+        statuses = facility.get_observation_statuses([sent, failed])
+        self.assertEqual(statuses[sent]['state'], 'IN_PROGRESS')
+        self.assertEqual(statuses[failed]['state'], 'FAILED')
+        self.assertEqual(facility.submitted_ids, {sent: '101'})
+
+        facility.update_all_observation_statuses()
+        self.assertEqual(ObservationRecord.objects.get(observation_id='101').status, 'IN_PROGRESS')
+        self.assertEqual(ObservationRecord.objects.get(observation_id=failed).status, 'FAILED')
+
+    @mock.patch.dict(LT_SETTINGS, QUEUED=True)
+    def test_queued_validation_does_not_wait_on_the_node_agent(self):
+        target = Target.objects.create(name='queued', type=Target.SIDEREAL, ra=10, dec=10, epoch=2000)
+        form = LTFacility().get_form('IOI')(dict(TestObservationPayload.form_data(target), observation_type='IOI',
+                                                 exp_time=60, exp_count=5))
+        with mock.patch('tom_lt.lt.call_node_agent') as call_node_agent:
+            self.assertTrue(form.is_valid(), form.errors)
+        call_node_agent.assert_not_called()
+
+
+class NodeAgentTestCase(TestCase):
+    """
+    Runs each test against a tom_lt.lt_node_agent stand-in, with a fresh circuit breaker, RTML
+    archive and caches.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.agent = NodeAgentStandIn().start()
+        cls.addClassCleanup(cls.agent.stop)
+
+    def setUp(self):
+        self.agent.reject = False
+        self.agent.status_mode = 'confirmation'
+        self.agent.image_urls = []
+        self.agent.failure_rate = 0
+        self.agent.calls = 0
+        self.agent.received = []
+
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        self.archive = RTMLArchive(archive_dir.name)
+        self.addCleanup(self.archive.flush)
+        self.breaker = CircuitBreaker(failure_threshold=5, cooldown=60)
+        for patch in (mock.patch.dict(LT_SETTINGS, LT_HOST=self.agent.host, LT_PORT=self.agent.port, DEBUG=False,
+                                      QUEUED=False),
+                      mock.patch.dict('tom_lt.lt._last_offers', clear=True),
+                      mock.patch('tom_lt.lt.node_agent_breaker', self.breaker),
+                      mock.patch('tom_lt.lt.rtml_archive', self.archive),
+                      mock.patch('tom_lt.lt.LT_RETRY_BASE_DELAY', 0),
+                      mock.patch('tom_lt.lt.LT_RETRY_MAX_DELAY', 0)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        caches[LT_VALIDATION_CACHE].clear()
+
+        self.target = Target.objects.create(name='m31', type=Target.SIDEREAL, ra=10.684, dec=41.269, epoch=2000)
+        self.facility = LTFacility()
+
+    def payload(self, **data):
+        form = self.facility.get_form('IOI')(dict(TestObservationPayload.form_data(self.target),
+                                                  observation_type='IOI', exp_time=60, exp_count=5, **data))
+        # Skip LTObservationForm.is_valid, which asks the node agent for an offer
+        self.assertTrue(super(LTObservationForm, form).is_valid(), form.errors)
+        return form.observation_payload()
+
+
+class TestNodeAgentSubmission(NodeAgentTestCase):
+    def test_submission_returns_and_archives_the_document_uid(self):
+        payload = self.payload()
+        uid = payload.element.get('uid')
+        self.assertEqual(self.facility.submit_observation(payload), [uid])
+        self.assertEqual(self.agent.calls, 1)
+        self.assertIn(uid, self.agent.received[0])
+        exchange, = self.archive.lookup(uid)
+        self.assertIn('confirmation', exchange['response'])
+
+    def test_rejected_submission_raises(self):
+        self.agent.reject = True
+        with self.assertRaises(RTMLRejectError):
+            self.facility.submit_observation(self.payload())
+
+    def test_batched_submission_reports_each_target(self):
+        other = Target.objects.create(name='m33', type=Target.SIDEREAL, ra=23.462, dec=30.66, epoch=2000)
+        config = dict(TestObservationPayload.form_data(self.target), observation_type='IOI', exp_time=60,
+                      exp_count=5)
+        results = self.facility.submit_observations([self.target, other.pk], config)
+        self.assertEqual([result['target_id'] for result in results], [self.target.pk, other.pk])
+        self.assertTrue(all(result.get('observation_id') for result in results))
+        self.assertEqual(self.agent.calls, 2)
+
+        self.agent.reject = True
+        results = self.facility.submit_observations([self.target, other], config)
+        self.assertTrue(all(result['errors'] and 'observation_id' not in result for result in results))
+
+    def test_cadence_batches_accepted_around_a_rejected_one(self):
+        payload = self.payload(cadence_interval=12, cadence_window=2)
+        windows = [schedule.find('{*}DateTimeConstraint/{*}DateTimeStart').get('value')
+                   for schedule in payload.element.findall('{*}Schedule')]
+        respond = self.agent.respond
+
+        def reject_second_window(document):
+            response = respond(document)
+            if windows[1] in document:
+                response = response.replace('mode="confirmation"', 'mode="reject" type="reject"')
+            return response
+
+        with mock.patch('tom_lt.lt.LT_CADENCE_BATCH_SIZE', 1), \
+                mock.patch.object(self.agent, 'respond', side_effect=reject_second_window):
+            observation_ids = self.facility.submit_observation(payload)
+        self.assertEqual(self.agent.calls, len(windows))
+        self.assertEqual(len(observation_ids), len(windows) - 1)
+        self.assertEqual(len(set(observation_ids)), len(observation_ids))
+        self.assertIsInstance(self.facility.submission_errors[0], RTMLRejectError)
+
+
+class TestNodeAgentValidation(NodeAgentTestCase):
+    def test_offer_validates_and_is_reused(self):
+        self.assertEqual(self.facility.validate_observation(self.payload()), [])
+        self.assertEqual(self.facility.validate_observation(self.payload()), [])
+        self.assertEqual(self.agent.calls, 1)
+        self.assertEqual(self.agent.received[0].count('mode="inquiry"'), 1)
+
+    def test_reject_is_reported(self):
+        self.agent.reject = True
+        errors = self.facility.validate_observation(self.payload(), remote=True)
+        self.assertIn('Error with RTML submission to Liverpool Telescope', errors)
+
+    def test_injected_failure_is_reported_after_retries(self):
+        self.agent.failure_rate = 1
+        errors = self.facility.validate_observation(self.payload(), remote=True)
+        self.assertIn('Error with connection to Liverpool Telescope', errors)
+        self.assertEqual(self.agent.calls, LT_INQUIRY_RETRIES + 1)
+
+
+class TestNodeAgentStatus(NodeAgentTestCase):
+    def test_statuses_are_fetched_together_and_cached(self):
+        self.agent.status_mode = 'complete'
+        statuses = self.facility.get_observation_statuses(['11', '12'])
+        self.assertEqual({status['state'] for status in statuses.values()}, {'COMPLETED'})
+        self.assertEqual(self.facility.status_calls, 2)
+        self.facility.get_observation_statuses(['11', '12'])
+        self.assertEqual(self.facility.status_calls, 0)
+
+    def test_failed_fetches_are_retried_then_left_out(self):
+        self.agent.failure_rate = 1
+        statuses = self.facility.get_observation_statuses(['21'], partial=True)
+        self.assertEqual(statuses, {})
+        self.assertIn('21', self.facility.status_failures)
+        # One batched attempt, then the retries of the idempotent inquiry
+        self.assertEqual(self.agent.calls, 1 + LT_INQUIRY_RETRIES + 1)
+        with self.assertRaises(Exception):
+            self.facility.get_observation_statuses(['21'])
+
+    def test_data_products_are_listed_from_the_status_response(self):
+        self.agent.status_mode = 'complete'
+        self.agent.image_urls = ['http://example.org/frames/h_e_20300101_1_1_1_1.fits']
+        product, = self.facility.data_products('31')
+        self.assertEqual(product['filename'], 'h_e_20300101_1_1_1_1.fits')
+
+
+class TestNodeAgentCancellation(NodeAgentTestCase):
+    def test_cancellation_is_acknowledged(self):
+        self.assertTrue(self.facility.cancel_observation('41'))
+        results = self.facility.cancel_observations(['42', '43'])
+        self.assertEqual([result['canceled'] for result in results], [True, True])
+        self.assertEqual(sum('mode="abort"' in document for document in self.agent.received), 3)
+
+    def test_failed_cancellation_reports_errors(self):
+        self.agent.failure_rate = 1
+        result, = self.facility.cancel_observations(['44'])
+        self.assertFalse(result['canceled'])
+        self.assertTrue(result['errors'])
+
+
+class TestCircuitBreaker(NodeAgentTestCase):
+    def test_opens_after_repeated_failures_and_fails_fast(self):
+        self.breaker.failure_threshold = 2
+        self.agent.failure_rate = 1
+        for _ in range(2):
+            with self.assertRaises(Exception):
+                self.facility.submit_observation(self.payload())
+        calls = self.agent.calls
+        with self.assertRaises(CircuitOpenError):
+            self.facility.submit_observation(self.payload())
+        self.assertEqual(self.agent.calls, calls)
+        self.facility.get_observation_statuses(['51'], partial=True)
+        self.assertIsInstance(self.facility.status_failures['51'], CircuitOpenError)
+        self.assertEqual(self.agent.calls, calls)
+
+
+class TestUIDs(TestCase):
+    def test_uids_are_unique_across_threads_and_increase_within_one(self):
+        batches = []
+
+        def generate():
+            batches.append([uid_generator.next() for _ in range(2000)])
+
+        threads = [threading.Thread(target=generate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for batch in batches:
+            self.assertEqual(batch, sorted(set(batch), key=int))
+        uids = [uid for batch in batches for uid in batch]
+        self.assertEqual(len(set(uids)), 8000)
+        self.assertTrue(all(len(uid) == 27 and uid.isdigit() for uid in uids))
+
+
+class TestResponseDecoding(TestCase):
+    RESPONSE = ('<?xml version="1.0" encoding="ISO-8859-1"?>\n<RTML xmlns="http://www.rtml.org/v3.1a" '
+                'mode="complete" uid="61"><Schedule><Target name="Fornax \u00e9toile"/>'
+                '<ImageData>http://example.org/1.fits</ImageData><ImageData>http://example.org/2.fits</ImageData>'
+                '</Schedule></RTML>')
+
+    def test_declared_encoding_is_honoured(self):
+        encoded = self.RESPONSE.encode('iso-8859-1')
+        # suds hands over decoded strings, the async transport raw bytes, possibly in small chunks
+        for response in (self.RESPONSE, encoded, [encoded[i:i + 7] for i in range(0, len(encoded), 7)]):
+            response = RTMLResponse(response)
+            self.assertEqual(response.get('mode'), 'complete')
+            self.assertEqual(response.element.find('{*}Schedule/{*}Target').get('name'), 'Fornax \u00e9toile')
+
+    def test_elements_are_read_incrementally(self):
+        encoded = self.RESPONSE.encode('iso-8859-1')
+        response = RTMLResponse([encoded[i:i + 5] for i in range(0, len(encoded), 5)])
+        self.assertEqual([element.text for element in response.iter('ImageData')],
+                         ['http://example.org/1.fits', 'http://example.org/2.fits'])
+
+
+class FrameServer:
+    """
+    Serves ``content`` over HTTP, honouring Range requests unless ``ranges`` is False, stopping
+    after ``truncate`` bytes when it is set and sending ``content_md5`` as the Content-MD5 header.
+    """
+    def __init__(self, content):
+        self.content = content
+        self.ranges = True
+        self.truncate = None
+        self.content_md5 = None
+        self.range_headers = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.range_headers.append(self.headers.get('Range'))
+                body, status = server.content, 200
+                if server.ranges and self.headers.get('Range'):
+                    body, status = body[int(self.headers['Range'][len('bytes='):].rstrip('-')):], 206
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                if server.content_md5:
+                    self.send_header('Content-MD5', server.content_md5)
+                self.end_headers()
+                self.wfile.write(body[:server.truncate])
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:{0}/frame.fits'.format(self._server.server_address[1])
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class TestDownload(SimpleTestCase):
+    CONTENT = bytes(range(256)) * 400
+
+    def setUp(self):
+        self.server = FrameServer(self.CONTENT)
+        self.addCleanup(self.server.stop)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'frames', 'frame.fits')
+
+    def download(self, **kwargs):
+        return lt_download.download(self.server.url, self.path, chunk_size=4096, timeout=10, **kwargs)
+
+    def test_interrupted_download_resumes_from_the_part_file(self):
+        self.server.truncate = 30000
+        with self.assertRaises(Exception):
+            self.download()
+        self.assertEqual(os.path.getsize(self.path + '.part'), 30000)
+
+        self.server.truncate = None
+        self.download(checksum=hashlib.md5(self.CONTENT).hexdigest())
+        self.assertEqual(self.server.range_headers, [None, 'bytes=30000-'])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.CONTENT)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+
+    def test_server_ignoring_the_range_restarts_the_file(self):
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path + '.part', 'wb') as f:
+            f.write(b'stale partial content')
+        self.server.ranges = False
+        self.download(checksum=hashlib.md5(self.CONTENT).hexdigest())
+        self.assertEqual(self.server.range_headers, ['bytes=21-'])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), self.CONTENT)
+
+    def test_content_md5_mismatch_deletes_the_partial_file(self):
+        self.server.content_md5 = base64.b64encode(hashlib.md5(b'something else').digest()).decode()
+        with self.assertRaises(lt_download.ChecksumError):
+            self.download()
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.assertFalse(os.path.exists(self.path))
+
+        self.server.content_md5 = base64.b64encode(hashlib.md5(self.CONTENT).digest()).decode()
+        self.download()
+        self.assertTrue(os.path.exists(self.path))
+
+
+class TestMetricsView(SimpleTestCase):
+    def get(self, user, **headers):
+        request = RequestFactory().get('/lt/metrics/', **headers)
+        request.user = user
+        return prometheus_view(request)
+
+    def test_only_staff_and_token_holders_see_the_metrics(self):
+        self.assertEqual(self.get(AnonymousUser()).status_code, 403)
+        self.assertEqual(self.get(User(username='user')).status_code, 403)
+        self.assertEqual(self.get(User(username='staff', is_staff=True)).status_code, 200)
+        with mock.patch.dict(LT_SETTINGS, METRICS_TOKEN='secret'):
+            self.assertEqual(self.get(AnonymousUser(), HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.get(AnonymousUser(), HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
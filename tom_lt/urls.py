@@ -15,6 +15,9 @@ Including another URLconf
 """
 from django.urls import path, include
 
+from tom_lt.lt_metrics import prometheus_view
+
 urlpatterns = [
+    path('lt/metrics/', prometheus_view, name='lt-metrics'),
     path('', include('tom_common.urls')),
 ]